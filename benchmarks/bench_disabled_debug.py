@@ -0,0 +1,51 @@
+"""
+Cost of a disabled `log.debug` call in a tight loop, before and after
+BoundLogger learned to return early for disabled levels.
+
+    PYTHONPATH=. python benchmarks/bench_disabled_debug.py
+
+"""
+import os
+import logging
+import timeit
+
+import gevent
+import structlog
+
+from nylas.logging.log import _build_processors, BoundLogger
+
+NUMBER = 100000
+
+
+class OldBoundLogger(structlog.stdlib.BoundLogger):
+    # BoundLogger as it was before it checked the level up front.
+    def _proxy_to_logger(self, method_name, event, *event_args, **event_kw):
+        event_kw['greenlet_id'] = id(gevent.getcurrent())
+        env = os.environ.get('NYLAS_ENV')
+        if env is not None:
+            event_kw['env'] = env
+        return super(OldBoundLogger, self)._proxy_to_logger(
+                method_name, event, *event_args, **event_kw)
+
+
+def loop_us(wrapper_class):
+    logger = logging.getLogger('bench')
+    logger.setLevel(logging.INFO)
+    log = structlog.wrap_logger(logger, processors=_build_processors(),
+                                wrapper_class=wrapper_class)
+
+    def loop():
+        for i in xrange(NUMBER):
+            log.debug('polled', item=i)
+    return min(timeit.Timer(loop).repeat(3, 1)) / NUMBER * 1e6
+
+
+def main():
+    old = loop_us(OldBoundLogger)
+    new = loop_us(BoundLogger)
+    print 'old: {:.3f} us/call'.format(old)
+    print 'new: {:.3f} us/call ({:.1f}x faster)'.format(new, old / new)
+
+
+if __name__ == '__main__':
+    main()
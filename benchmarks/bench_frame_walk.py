@@ -0,0 +1,70 @@
+"""
+Compare the uncached and cached frame walks behind `_record_module`.
+
+The logging call is issued beneath `depth` frames of library code that is
+ignored (e.g. SQLAlchemy event listeners), which is the expensive case.
+
+    PYTHONPATH=. python benchmarks/bench_frame_walk.py
+
+"""
+import sys
+import timeit
+
+from nylas.logging.log import _find_app_frame, IGNORED_MODULE_PREFIXES
+
+DEPTHS = (5, 20, 50)
+NUMBER = 20000
+
+
+# The walk as it was before code objects were cached. It has to look like
+# it lives in nylas.logging, or it would stop at its own frame.
+_logging_namespace = {'__name__': 'nylas.logging.log', 'sys': sys,
+                      'IGNORED_MODULE_PREFIXES': IGNORED_MODULE_PREFIXES}
+exec("""
+def old_walk():
+    ignores = list(IGNORED_MODULE_PREFIXES)
+    f = sys._getframe()
+    name = f.f_globals.get('__name__')
+    while f is not None and f.f_back is not None and \\
+            (name is None or any(name.startswith(i) for i in ignores)):
+        f = f.f_back
+        name = f.f_globals.get('__name__')
+    return f
+""", _logging_namespace)
+old_walk = _logging_namespace['old_walk']
+new_walk = _find_app_frame
+
+_library_namespace = {'__name__': 'sqlalchemy.orm.events'}
+exec("""
+def library_call(depth, fn):
+    if depth:
+        return library_call(depth - 1, fn)
+    return fn()
+""", _library_namespace)
+library_call = _library_namespace['library_call']
+
+
+def app_call(depth, walk):
+    return library_call(depth, walk)
+
+
+def run(depth, walk):
+    timer = timeit.Timer(lambda: app_call(depth, walk))
+    return min(timer.repeat(3, NUMBER)) / NUMBER * 1e6
+
+
+def main():
+    # Both walks must agree on which frame is the app frame.
+    assert app_call(5, old_walk).f_code is app_call.__code__
+    assert app_call(5, new_walk).f_code is app_call.__code__
+    print '{:>6} {:>12} {:>12} {:>8}'.format('depth', 'old (us)', 'new (us)',
+                                             'speedup')
+    for depth in DEPTHS:
+        old = run(depth, old_walk)
+        new = run(depth, new_walk)
+        print '{:>6} {:>12.2f} {:>12.2f} {:>7.1f}x'.format(depth, old, new,
+                                                           old / new)
+
+
+if __name__ == '__main__':
+    main()
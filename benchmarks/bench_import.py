@@ -0,0 +1,46 @@
+"""
+Startup cost of importing nylas.logging (and nylas.logging.sentry): wall
+time and peak memory of a fresh interpreter, compared to one that imports
+nothing.
+
+    PYTHONPATH=. python benchmarks/bench_import.py
+
+"""
+import os
+import sys
+import subprocess
+
+REPEAT = 20
+
+SCRIPT = """
+import time, resource, sys
+start = time.time()
+{statement}
+elapsed = time.time() - start
+heavy = [m for m in ('gevent', 'colorlog', 'raven') if m in sys.modules]
+print elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, \\
+    ','.join(heavy) or '-'
+"""
+
+
+def measure(statement):
+    timings = []
+    for _ in range(REPEAT):
+        output = subprocess.check_output(
+            [sys.executable, '-c', SCRIPT.format(statement=statement)],
+            env=os.environ)
+        elapsed, max_rss, heavy = output.split()
+        timings.append(float(elapsed))
+    return min(timings), int(max_rss), heavy
+
+
+def main():
+    for statement in ('pass', 'import nylas.logging',
+                      'import nylas.logging.sentry'):
+        elapsed, max_rss, heavy = measure(statement)
+        print '{:<28} {:>6.1f} ms {:>7} KB peak RSS  (loaded: {})'.format(
+            statement, elapsed * 1000, max_rss, heavy)
+
+
+if __name__ == '__main__':
+    main()
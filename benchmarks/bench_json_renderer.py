@@ -0,0 +1,70 @@
+"""
+Events per second rendered by structlog's JSONRenderer and by
+nylas.logging.renderers.JSONRenderer with each available serializer, on
+representative `request handled` events.
+
+    PYTHONPATH=. python benchmarks/bench_json_renderer.py
+
+"""
+import datetime
+import timeit
+
+import structlog
+
+from nylas.logging.renderers import JSONRenderer, SERIALIZERS
+
+NUMBER = 20000
+
+
+def request_handled_event():
+    return {
+        'event': u'request handled',
+        'level': u'info',
+        'timestamp': u'2016-09-20T18:31:05.123456Z',
+        'module': u'nylas.api.wsgi:71',
+        'greenlet_id': 140371123456789,
+        'env': u'prod',
+        'response_bytes': 1843,
+        'request_time': 0.023416,
+        'remote_addr': u'10.0.12.34',
+        'http_status': 200,
+        'http_request': u'GET /threads?limit=50&offset=0 HTTP/1.1',
+        'request_method': u'GET',
+        'request_uid': u'6f1c2a9e-3f2d-4c8e-9b0a-1d2e3f4a5b6c',
+        'account_id': 123456,
+        'provider': u'gmail',
+    }
+
+
+def with_extra_types(event):
+    event = dict(event)
+    event['started_at'] = datetime.datetime(2016, 9, 20, 18, 31, 5, 100000)
+    event['folders'] = set([u'inbox', u'sent'])
+    return event
+
+
+def events_per_second(renderer, event):
+    timer = timeit.Timer(lambda: renderer(None, 'info', event))
+    return NUMBER / min(timer.repeat(3, NUMBER))
+
+
+def main():
+    renderers = [('structlog', structlog.processors.JSONRenderer())]
+    for name in sorted(SERIALIZERS):
+        try:
+            renderers.append((name, JSONRenderer(serializer=name)))
+        except ImportError:
+            pass
+
+    plain = request_handled_event()
+    extra = with_extra_types(plain)
+    print '{:>12} {:>14} {:>20}'.format('renderer', 'events/s',
+                                        'events/s (extra)')
+    for name, renderer in renderers:
+        print '{:>12} {:>14,.0f} {:>20,.0f}'.format(
+            name, events_per_second(renderer, plain),
+            events_per_second(renderer, extra))
+
+
+if __name__ == '__main__':
+    main()
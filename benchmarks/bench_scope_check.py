@@ -0,0 +1,68 @@
+"""
+Measure the per-call cost of `_is_log_in_same_fn_scope`, the check that runs
+on every `log.error`, against the previous source-scanning implementation.
+
+    PYTHONPATH=. python benchmarks/bench_scope_check.py
+
+"""
+import re
+import sys
+import timeit
+import traceback
+
+from nylas.logging.log import _is_log_in_same_fn_scope
+
+DEPTHS = (20, 50, 100)
+NUMBER = 2000
+
+
+def old_is_log_in_same_fn_scope(exc_tb):
+    # The check as it was before it compared code objects.
+    cur_stack = traceback.extract_stack()
+    calling_fn = None
+    for fname, line_num, fn_name, code in reversed(cur_stack):
+        if code and re.search("log\.(error|exception)", code):
+            calling_fn = fn_name
+            break
+
+    exc_tb_stack = traceback.extract_tb(exc_tb)
+    for fname, line_num, fn_name, code in exc_tb_stack:
+        if fn_name == calling_fn:
+            return True
+    return False
+
+
+def fail():
+    raise ValueError('boom')
+
+
+def handler(check):
+    try:
+        fail()
+    except ValueError:
+        exc_tb = sys.exc_info()[2]
+        # The old check looks for this source line: log.error
+        timer = timeit.Timer(lambda: check(exc_tb))  # log.error
+        assert check(exc_tb)  # log.error
+        return min(timer.repeat(3, NUMBER)) / NUMBER * 1e6
+
+
+def nested(depth, check):
+    if depth:
+        return nested(depth - 1, check)
+    return handler(check)
+
+
+def main():
+    base = len(traceback.extract_stack())
+    print '{:>6} {:>12} {:>12} {:>8}'.format('depth', 'old (us)', 'new (us)',
+                                             'speedup')
+    for depth in DEPTHS:
+        old = nested(depth - base, old_is_log_in_same_fn_scope)
+        new = nested(depth - base, _is_log_in_same_fn_scope)
+        print '{:>6} {:>12.2f} {:>12.2f} {:>7.1f}x'.format(depth, old, new,
+                                                           old / new)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+"""
+Greenlet switch throughput with no tracer, with the regular Tracer switch
+hook (with and without gather_stats) and with the light one.
+
+    PYTHONPATH=. python benchmarks/bench_tracer_switch.py
+
+"""
+import time
+import collections
+
+import gevent
+import greenlet
+
+from nylas.util.debug import Tracer
+
+NUM_GREENLETS = 10
+SWITCHES_PER_GREENLET = 20000
+REPEAT = 7
+
+
+def yield_often():
+    for _ in xrange(SWITCHES_PER_GREENLET):
+        gevent.sleep(0)
+
+
+def run(trace):
+    greenlet.settrace(trace)
+    start = time.time()
+    gevent.joinall([gevent.spawn(yield_often)
+                    for _ in range(NUM_GREENLETS)])
+    elapsed = time.time() - start
+    greenlet.settrace(None)
+    return elapsed
+
+
+def main():
+    counter = Tracer()
+    run(counter._trace)
+    switches = counter.total_switches
+
+    # Tracers are created but not started: we only measure the switch hook,
+    # not the monitoring thread. Runs are interleaved to even out noise.
+    candidates = [
+        ('no tracer', lambda: None),
+        ('tracer', lambda: Tracer()._trace),
+        ('tracer, gather_stats', lambda: Tracer(gather_stats=True)._trace),
+        ('light tracer', lambda: Tracer(light=True)._make_light_trace()),
+    ]
+    timings = collections.defaultdict(list)
+    for _ in range(REPEAT):
+        for name, make_trace in candidates:
+            timings[name].append(run(make_trace()))
+    for name, _ in candidates:
+        print '{:<22} {:>10.0f} switches/s'.format(
+            name, switches / min(timings[name]))
+
+
+if __name__ == '__main__':
+    main()
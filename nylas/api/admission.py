@@ -0,0 +1,55 @@
+"""
+Admission control: shed requests early, rather than queueing them behind a
+saturated event loop.
+
+"""
+import collections
+
+
+IN_FLIGHT = 'in_flight'
+LOOP_LAG = 'loop_lag'
+
+
+class AdmissionControl(object):
+    """Track in-flight requests, and decide whether new ones should be
+    handled or shed.
+
+    Limits are passed to `admit` rather than stored, so that they can be
+    changed at any time.
+
+    Parameters
+    ----------
+    loop_lag_monitor: nylas.util.debug.LoopLagMonitor, optional
+        Where to get the event loop lag from. Required to shed on loop lag.
+    """
+    def __init__(self, loop_lag_monitor=None):
+        self.loop_lag_monitor = loop_lag_monitor
+        self.in_flight = 0
+        self.shed = collections.Counter()
+
+    def admit(self, max_in_flight=0, max_loop_lag=0):
+        """Return None if a request should be handled, in which case it
+        counts as in flight until `release` is called. Otherwise, return the
+        reason to shed it ('in_flight' or 'loop_lag'). Limits of 0 aren't
+        enforced.
+
+        Loop lag is the monitor's `recent_lag`, so that requests keep being
+        shed for a while after the loop was blocked, rather than only until
+        the next on-time tick."""
+        if max_in_flight and self.in_flight >= max_in_flight:
+            reason = IN_FLIGHT
+        elif max_loop_lag and self.loop_lag_monitor is not None and \
+                self.loop_lag_monitor.recent_lag > max_loop_lag:
+            reason = LOOP_LAG
+        else:
+            self.in_flight += 1
+            return None
+        self.shed[reason] += 1
+        return reason
+
+    def release(self):
+        self.in_flight -= 1
+
+    @property
+    def total_shed(self):
+        return sum(self.shed.values())
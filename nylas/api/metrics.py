@@ -0,0 +1,92 @@
+"""
+In-process aggregates of request timings, so that latency percentiles are
+available without parsing request logs downstream.
+
+"""
+import re
+
+from nylas.util.histogram import Histogram
+
+
+# Upper bound on the number of distinct routes, methods and statuses tracked.
+# Further ones are aggregated under OTHER.
+MAX_KEYS = 200
+OTHER = 'other'
+
+# Path segments containing a digit are most likely IDs.
+_ID_SEGMENT = re.compile(r'/[^/]*\d[^/]*')
+
+
+def route_for_path(path):
+    """Return a low-cardinality route for a request path, for requests that
+    don't set one explicitly."""
+    if not path:
+        return path
+    return _ID_SEGMENT.sub('/*', path.split('?', 1)[0])
+
+
+class _Histograms(object):
+    """Request time histograms keyed on e.g. route, bounded to `max_keys`
+    keys."""
+    def __init__(self, max_keys):
+        self.max_keys = max_keys
+        self._histograms = {}
+
+    def add(self, key, value):
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            if len(self._histograms) >= self.max_keys:
+                key = OTHER
+                histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram()
+        histogram.add(value)
+
+    def summary(self):
+        return {key: histogram.summary() for key, histogram in
+                self._histograms.iteritems()}
+
+
+class RequestMetrics(object):
+    """Aggregate request times per route, method and status in fixed-bucket
+    histograms, using constant memory.
+
+    Parameters
+    ----------
+    max_keys: int
+        Maximum number of distinct routes (and methods, and statuses) to keep
+        separate histograms for.
+    """
+    def __init__(self, max_keys=MAX_KEYS):
+        self.max_keys = max_keys
+        self.reset()
+
+    def reset(self):
+        self.requests = 0
+        self.response_bytes = 0
+        self.request_time = Histogram()
+        self._by_route = _Histograms(self.max_keys)
+        self._by_method = _Histograms(self.max_keys)
+        self._by_status = _Histograms(self.max_keys)
+
+    def record(self, route, method, status, request_time, response_bytes):
+        self.requests += 1
+        self.response_bytes += response_bytes or 0
+        self.request_time.add(request_time)
+        self._by_route.add(route, request_time)
+        self._by_method.add(method, request_time)
+        self._by_status.add(status, request_time)
+
+    def snapshot(self):
+        return {'requests': self.requests,
+                'response_bytes': self.response_bytes,
+                'request_time': self.request_time.summary(),
+                'by_route': self._by_route.summary(),
+                'by_method': self._by_method.summary(),
+                'by_status': self._by_status.summary()}
+
+    def pop_snapshot(self):
+        """Return a snapshot and start aggregating anew."""
+        snapshot = self.snapshot()
+        self.reset()
+        return snapshot
@@ -0,0 +1,68 @@
+"""
+Timing of named sections ("spans") of a request, e.g. database queries or
+template rendering:
+
+    with span('db'):
+        ...
+
+Spans are recorded in a list on the greenlet handling the request, and only
+reported for slow requests (see NylasWSGIHandler). Outside of a request,
+`span` doesn't record anything.
+
+"""
+import time
+
+from greenlet import getcurrent
+
+
+# Maximum number of spans reported for a request, on top of the per-name
+# totals.
+MAX_REPORTED_SPANS = 50
+
+_ATTRIBUTE = '_nylas_request_spans'
+
+
+class span(object):
+    """Context manager that records how long its block takes under `name`
+    in the current request."""
+    __slots__ = ('name', 'start', 'spans')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.spans = getattr(getcurrent(), _ATTRIBUTE, None)
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if self.spans is not None:
+            self.spans.append((self.name, self.start, time.time()))
+
+
+def start_request_spans():
+    """Start recording spans in the current greenlet."""
+    setattr(getcurrent(), _ATTRIBUTE, [])
+
+
+def pop_request_spans():
+    """Stop recording spans in the current greenlet, and return the list of
+    (name, start time, end time) recorded so far."""
+    glet = getcurrent()
+    spans = getattr(glet, _ATTRIBUTE, None)
+    if spans is not None:
+        delattr(glet, _ATTRIBUTE)
+    return spans
+
+
+def summarize_spans(spans, start_time):
+    """Return the total time per span name, and the first MAX_REPORTED_SPANS
+    spans as [name, offset from start_time, duration] lists, with times in
+    seconds."""
+    totals = {}
+    for name, start, end in spans:
+        totals[name] = totals.get(name, 0) + end - start
+    timeline = [[name, round(start - start_time, 6), round(end - start, 6)]
+                for name, start, end in spans[:MAX_REPORTED_SPANS]]
+    return {name: round(total, 6) for name, total in totals.iteritems()}, \
+        timeline
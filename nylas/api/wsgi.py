@@ -1,13 +1,23 @@
+import time
 import socket
 import errno
+import traceback
 
+import gevent
 from gevent.pywsgi import WSGIHandler, WSGIServer
 
 from gunicorn.workers.ggevent import GeventWorker
 import gunicorn.glogging
 
-from nylas.util.debug import Tracer
-from nylas.logging import get_logger, configure_logging
+from nylas.api.admission import AdmissionControl
+from nylas.api.metrics import RequestMetrics, route_for_path
+from nylas.api.spans import (start_request_spans, pop_request_spans,
+                             summarize_spans)
+from nylas.util.debug import Tracer, LoopLagMonitor
+from nylas.logging import (get_logger, configure_logging, flush_logging,
+                           get_request_context, set_request_context,
+                           clear_request_context)
+from nylas.logging.sentry import flush_sentry_delivery
 log = get_logger()
 
 # Monkeypatch with values from your app's config file to change.
@@ -17,10 +27,53 @@ MAX_BLOCKING_TIME = 1.
 # Same deal here (with monkeypatching).
 LOGLEVEL = 10
 
+# Aggregate request metrics, and log a summary of them every
+# METRICS_INTERVAL seconds. 0 (the default) disables both.
+METRICS_INTERVAL = 0
+
+# Attach span timings (see nylas.api.spans) to the 'request handled' line of
+# requests that take more than SLOW_REQUEST_TIME seconds. Set to 0 to
+# disable.
+SLOW_REQUEST_TIME = 1.
+
+# Also capture the stack of requests that are still running after
+# SLOW_REQUEST_TIME seconds. This costs a timer per request.
+SLOW_REQUEST_STACK = False
+
+# Admission control: respond with a 503 right away, without running the
+# app, while MAX_IN_FLIGHT_REQUESTS requests are already being handled, or
+# while the event loop lagged by more than MAX_LOOP_LAG seconds within the
+# last LOOP_LAG_RECENT_WINDOW (see nylas.util.debug). Set to 0 to disable
+# either check.
+MAX_IN_FLIGHT_REQUESTS = 0
+MAX_LOOP_LAG = 0
+RETRY_AFTER = 1
+
+# Streaming mode, for long-lived responses that the app opts into by setting
+# environ['nylas.streaming'] before returning: close the connection if the
+# client doesn't accept a chunk within STREAM_WRITE_TIMEOUT seconds, so that
+# stalled clients don't pin response data in memory. Set to 0 to disable the
+# timeout.
+STREAM_WRITE_TIMEOUT = 60
+
+# In streaming mode, chunks of at least this size are sent straight from
+# the app's buffer instead of being copied into one with their chunked
+# encoding framing.
+MIN_ZERO_COPY_CHUNK = 16 * 1024
+
+request_metrics = RequestMetrics()
+admission_control = AdmissionControl()
+
+_SHED_BODY = 'Service Unavailable\n'
+
 
 class NylasWSGIHandler(WSGIHandler):
     """Custom WSGI handler class to customize request logging. Based on
     gunicorn.workers.ggevent.PyWSGIHandler."""
+    _shed_reason = None
+    _slow_stack = None
+    _streaming = False
+
     def log_request(self):
         # gevent.pywsgi tries to call log.write(), but Python logger objects
         # implement log.debug(), log.info(), etc., so we need to monkey-patch
@@ -62,6 +115,42 @@ class NylasWSGIHandler(WSGIHandler):
             additional_context['error_message'] = getattr(self, 'status', None)
             status = abs(status)
 
+        spans = pop_request_spans()
+        if SLOW_REQUEST_TIME and self.time_finish and \
+                request_time >= SLOW_REQUEST_TIME:
+            if spans:
+                additional_context['span_totals'], \
+                    additional_context['spans'] = \
+                    summarize_spans(spans, self.time_start)
+            if self._slow_stack is not None:
+                additional_context['slow_request_stack'] = self._slow_stack
+
+        if self._streaming:
+            additional_context['streaming'] = True
+            additional_context['stream_chunks'] = self._stream_chunks
+            additional_context['stream_bytes'] = self._stream_bytes
+            if self.time_finish:
+                additional_context['stream_duration'] = \
+                    round(self.time_finish - self._stream_start, 6)
+            if self._stream_timed_out:
+                additional_context['stream_timed_out'] = True
+
+        if MAX_IN_FLIGHT_REQUESTS or MAX_LOOP_LAG:
+            additional_context['in_flight_requests'] = \
+                admission_control.in_flight
+            additional_context['shed_requests'] = admission_control.total_shed
+            if self._shed_reason is not None:
+                additional_context['shed_reason'] = self._shed_reason
+
+        if METRICS_INTERVAL and self.time_finish:
+            # Apps can set a route (e.g. the URL rule that matched) in the
+            # request context or the environ; otherwise IDs are stripped
+            # from the path.
+            route = get_request_context().get('route') or \
+                self.environ.get('nylas.route') or route_for_path(self.path)
+            request_metrics.record(route, method, status, request_time,
+                                   length)
+
         log.info('request handled',
                  response_bytes=length,
                  request_time=request_time,
@@ -71,6 +160,93 @@ class NylasWSGIHandler(WSGIHandler):
                  request_method=method,
                  **additional_context)
 
+    def handle_one_response(self):
+        self._shed_reason = None
+        self._streaming = False
+        admitted = False
+        if MAX_IN_FLIGHT_REQUESTS or MAX_LOOP_LAG:
+            self._shed_reason = admission_control.admit(
+                MAX_IN_FLIGHT_REQUESTS, MAX_LOOP_LAG)
+            admitted = self._shed_reason is None
+        # Everything logged while handling the request, including the
+        # 'request handled' line, carries the request context. The app can
+        # add to it with bind_request_context(), e.g. to set the route.
+        context = {'request_method': self.command,
+                   'request_path': self.path.split('?', 1)[0]}
+        request_uid = self.headers.get('X-Unique-Id')
+        if request_uid is not None:
+            context['request_uid'] = request_uid
+        set_request_context(**context)
+        timer = None
+        if SLOW_REQUEST_TIME:
+            start_request_spans()
+            self._slow_stack = None
+            if SLOW_REQUEST_STACK:
+                timer = gevent.get_hub().loop.timer(SLOW_REQUEST_TIME)
+                timer.start(self._capture_slow_stack, gevent.getcurrent())
+        try:
+            super(NylasWSGIHandler, self).handle_one_response()
+        finally:
+            if timer is not None:
+                timer.stop()
+            if admitted:
+                admission_control.release()
+            pop_request_spans()
+            clear_request_context()
+
+    def run_application(self):
+        if self._shed_reason is None:
+            return super(NylasWSGIHandler, self).run_application()
+        self.start_response('503 Service Unavailable',
+                            [('Content-Type', 'text/plain'),
+                             ('Content-Length', str(len(_SHED_BODY))),
+                             ('Retry-After', str(RETRY_AFTER))])
+        self.write(_SHED_BODY)
+
+    def process_result(self):
+        if not self.environ.get('nylas.streaming'):
+            return super(NylasWSGIHandler, self).process_result()
+        self._streaming = True
+        self._stream_chunks = 0
+        self._stream_bytes = 0
+        self._stream_start = time.time()
+        self._stream_timed_out = False
+        # The socket timeout applies to each sendall() call, i.e. to each
+        # chunk.
+        timeout = self.socket.gettimeout()
+        if STREAM_WRITE_TIMEOUT:
+            self.socket.settimeout(STREAM_WRITE_TIMEOUT)
+        try:
+            super(NylasWSGIHandler, self).process_result()
+        except socket.timeout:
+            self._stream_timed_out = True
+            self.close_connection = True
+        finally:
+            self.socket.settimeout(timeout)
+
+    def _write(self, data):
+        if not self._streaming:
+            return super(NylasWSGIHandler, self)._write(data)
+        if not data:
+            return
+        self._stream_chunks += 1
+        self._stream_bytes += len(data)
+        if len(data) < MIN_ZERO_COPY_CHUNK:
+            return super(NylasWSGIHandler, self)._write(data)
+        # A few more syscalls, but no copy of the chunk.
+        if self.response_use_chunked:
+            self._sendall('%x\r\n' % len(data))
+        self._sendall(memoryview(data))
+        if self.response_use_chunked:
+            self._sendall('\r\n')
+
+    def _capture_slow_stack(self, glet):
+        # Runs in the hub, so the request's greenlet is suspended and its
+        # frame shows what it's waiting on.
+        frame = glet.gr_frame
+        if frame is not None:
+            self._slow_stack = ''.join(traceback.format_stack(frame))
+
     def get_environ(self):
         env = super(NylasWSGIHandler, self).get_environ()
         env['gunicorn.sock'] = self.socket
@@ -100,6 +276,26 @@ class NylasWSGIWorker(GeventWorker):
             self.tracer.start()
         super(NylasWSGIWorker, self).init_process()
 
+    def run(self):
+        if METRICS_INTERVAL:
+            gevent.spawn(self._log_metrics)
+        if MAX_LOOP_LAG:
+            admission_control.loop_lag_monitor = LoopLagMonitor()
+            admission_control.loop_lag_monitor.start()
+        try:
+            super(NylasWSGIWorker, self).run()
+        finally:
+            # Don't lose buffered log records or queued Sentry events when
+            # the worker is recycled.
+            flush_sentry_delivery()
+            flush_logging()
+
+    def _log_metrics(self):
+        while True:
+            gevent.sleep(METRICS_INTERVAL)
+            log.info('request metrics', interval=METRICS_INTERVAL,
+                     **request_metrics.pop_snapshot())
+
 
 class NylasGunicornLogger(gunicorn.glogging.Logger):
     def __init__(self, cfg):
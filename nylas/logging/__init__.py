@@ -2,13 +2,18 @@ from pkgutil import extend_path
 from nylas.logging.log import (find_first_app_frame_and_name,
                                safe_format_exception, BoundLogger,
                                get_logger, configure_logging,
-                               create_error_log_context,
+                               flush_logging, create_error_log_context,
                                MAX_EXCEPTION_LENGTH)
+from nylas.logging.context import (get_request_context, set_request_context,
+                                   bind_request_context,
+                                   clear_request_context, request_context)
 
 # Allow out-of-tree submodules.
 __path__ = extend_path(__path__, __name__)
 
 __all__ = ['find_first_app_frame_and_name', 'safe_format_exception',
-           'BoundLogger', 'get_logger', 'configure_logging',
-           'create_error_log_context',
+           'BoundLogger', 'get_logger', 'configure_logging', 'flush_logging',
+           'create_error_log_context', 'get_request_context',
+           'set_request_context', 'bind_request_context',
+           'clear_request_context', 'request_context',
            'MAX_EXCEPTION_LENGTH']
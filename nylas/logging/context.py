@@ -0,0 +1,64 @@
+"""
+Request-scoped log context.
+
+The context is local to the current greenlet, and is merged into every event
+logged from it (keys passed to the log call take precedence). Contexts are
+never modified in place: binding new values replaces the greenlet's context
+with an updated copy, so a context handed out by `get_request_context` stays
+valid, and unchanged contexts cost nothing per log call.
+
+"""
+from contextlib import contextmanager
+
+from greenlet import getcurrent
+
+
+_EMPTY = {}
+_ATTRIBUTE = '_nylas_request_context'
+
+
+def get_request_context():
+    """Return the current greenlet's request context. Don't modify it."""
+    return getattr(getcurrent(), _ATTRIBUTE, _EMPTY)
+
+
+def set_request_context(**values):
+    """Replace the current greenlet's request context."""
+    setattr(getcurrent(), _ATTRIBUTE, values)
+
+
+def bind_request_context(**values):
+    """Add values to the current greenlet's request context."""
+    glet = getcurrent()
+    context = dict(getattr(glet, _ATTRIBUTE, _EMPTY))
+    context.update(values)
+    setattr(glet, _ATTRIBUTE, context)
+
+
+def clear_request_context():
+    glet = getcurrent()
+    if hasattr(glet, _ATTRIBUTE):
+        delattr(glet, _ATTRIBUTE)
+
+
+@contextmanager
+def request_context(**values):
+    """Add values to the current greenlet's request context for the
+    duration of a with block."""
+    glet = getcurrent()
+    previous = getattr(glet, _ATTRIBUTE, _EMPTY)
+    bind_request_context(**values)
+    try:
+        yield
+    finally:
+        setattr(glet, _ATTRIBUTE, previous)
+
+
+def merge_request_context(logger, name, event_dict):
+    """Processor that adds the request context to the event."""
+    context = getattr(getcurrent(), _ATTRIBUTE, _EMPTY)
+    if context:
+        for key, value in context.iteritems():
+            if key not in event_dict:
+                event_dict[key] = value
+    return event_dict
@@ -0,0 +1,139 @@
+"""
+Fingerprinting of tracebacks, and a cache of their formatted text.
+
+A fingerprint identifies where an exception came from: its type plus the
+code object and line number of every traceback frame. It's cheap to build
+(no source is read), so repeats of the same failure can reuse the text that
+was formatted the first time.
+
+"""
+import time
+import hashlib
+import traceback
+import collections
+
+from nylas.util.threads import LazyNativeLock
+
+MAX_CACHE_ENTRIES = 1000
+MAX_CACHE_BYTES = 4 * 1024 * 1024
+
+
+def traceback_fingerprint(exc_type, tb):
+    """Return a hashable fingerprint for an exception type and traceback."""
+    frames = []
+    while tb is not None:
+        frames.append((tb.tb_frame.f_code, tb.tb_lineno))
+        tb = tb.tb_next
+    return exc_type, tuple(frames)
+
+
+def fingerprint_digest(fingerprint):
+    """Return a short hex digest of a fingerprint. Unlike the fingerprint
+    itself, this is stable across processes, so it can be used to group
+    errors downstream."""
+    exc_type, frames = fingerprint
+    parts = ['{}.{}'.format(getattr(exc_type, '__module__', None),
+                            getattr(exc_type, '__name__', exc_type))]
+    for code, lineno in frames:
+        parts.append('{}:{}:{}'.format(code.co_filename, code.co_name,
+                                       lineno))
+    return hashlib.md5('\n'.join(parts)).hexdigest()[:16]
+
+
+class _Entry(object):
+    __slots__ = ('digest', 'formatted_tb')
+
+    def __init__(self, digest, formatted_tb):
+        self.digest = digest
+        self.formatted_tb = formatted_tb
+
+
+class TracebackCache(object):
+    """LRU cache of formatted tracebacks keyed by fingerprint, bounded both
+    by number of entries and by the total size of the cached text.
+
+    Also keeps track of how often each fingerprint repeats, so that callers
+    can avoid emitting the same traceback over and over again.
+
+    Safe to use from several OS threads, e.g. Tracer's monitoring thread.
+
+    Parameters
+    ----------
+    max_entries: int
+        Maximum number of tracebacks to keep.
+    max_bytes: int
+        Maximum total length of the cached traceback text.
+    repeat_window: float, optional
+        Length in seconds of the window used by `count_repeat`. If None,
+        repeats aren't tracked.
+    """
+    def __init__(self, max_entries=MAX_CACHE_ENTRIES,
+                 max_bytes=MAX_CACHE_BYTES, repeat_window=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.repeat_window = repeat_window
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._bytes = 0
+        # digest -> [window start, number of repeats in the window]
+        self._repeats = collections.OrderedDict()
+        self._lock = LazyNativeLock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def lookup(self, exc_type, tb):
+        """Return an entry with the `digest` and `formatted_tb` (the output of
+        traceback.format_tb, joined) for the given traceback."""
+        key = traceback_fingerprint(exc_type, tb)
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self.hits += 1
+                self._entries[key] = entry
+                return entry
+            self.misses += 1
+
+        # Formatted without the lock held; another thread may cache the
+        # same traceback meanwhile, in which case this entry replaces it.
+        entry = _Entry(fingerprint_digest(key),
+                       ''.join(traceback.format_tb(tb)))
+        size = len(entry.formatted_tb)
+        if size <= self.max_bytes:
+            with self._lock:
+                replaced = self._entries.pop(key, None)
+                if replaced is not None:
+                    self._bytes -= len(replaced.formatted_tb)
+                self._entries[key] = entry
+                self._bytes += size
+                while len(self._entries) > self.max_entries or \
+                        self._bytes > self.max_bytes:
+                    _, evicted = self._entries.popitem(last=False)
+                    self._bytes -= len(evicted.formatted_tb)
+        return entry
+
+    def count_repeat(self, digest, now=None):
+        """Record an occurrence of the traceback with the given digest.
+        Returns 0 if this is the first occurrence within the repeat window,
+        otherwise the number of repeats so far in the window."""
+        if self.repeat_window is None:
+            return 0
+        if now is None:
+            now = time.time()
+        with self._lock:
+            state = self._repeats.pop(digest, None)
+            if state is None or now - state[0] >= self.repeat_window:
+                state = [now, 0]
+            else:
+                state[1] += 1
+            self._repeats[digest] = state
+            if len(self._repeats) > self.max_entries:
+                self._repeats.popitem(last=False)
+            return state[1]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._repeats.clear()
+            self._bytes = 0
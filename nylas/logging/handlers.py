@@ -0,0 +1,295 @@
+"""
+Log handlers that keep slow output streams from blocking the gevent hub.
+
+"""
+import os
+import sys
+import time
+import logging
+import collections
+
+from nylas.util.threads import native_threading, thread_ident_function
+
+
+DROP_OLDEST = 'drop_oldest'
+DROP_DEBUG_FIRST = 'drop_debug_first'
+BLOCK = 'block'
+OVERFLOW_POLICIES = (DROP_OLDEST, DROP_DEBUG_FIRST, BLOCK)
+
+MAX_QUEUE_SIZE = 10000
+MAX_BATCH_BYTES = 64 * 1024
+MAX_BUFFER_LATENCY = 0.005
+
+
+class AsyncStreamHandler(logging.Handler):
+    """Handler that formats records on the calling thread, queues them in a
+    bounded in-memory buffer and writes them to `stream` from a dedicated OS
+    thread in batches.
+
+    The drain thread is started lazily on the first record, and restarted in
+    a forked child (records queued by the parent are discarded there, since
+    the parent still owns them). Remaining records are written out by
+    `flush()`, which `logging.shutdown()` calls at interpreter exit.
+
+    Parameters
+    ----------
+    stream: file-like, optional
+        Where to write. Defaults to sys.stdout.
+    max_queue_size: int
+        Number of records to buffer before applying `overflow_policy`.
+    overflow_policy: str
+        One of 'drop_oldest' (discard the oldest queued record),
+        'drop_debug_first' (discard queued or incoming debug records first,
+        then the oldest record) or 'block' (wait for the drain thread to make
+        room).
+    max_batch_bytes: int
+        Upper bound on the size of a single write.
+    """
+    def __init__(self, stream=None, max_queue_size=MAX_QUEUE_SIZE,
+                 overflow_policy=DROP_OLDEST,
+                 max_batch_bytes=MAX_BATCH_BYTES):
+        if overflow_policy not in OVERFLOW_POLICIES:
+            raise ValueError('Unknown overflow policy {!r}'
+                             .format(overflow_policy))
+        logging.Handler.__init__(self)
+        self.stream = stream or sys.stdout
+        self.max_queue_size = max_queue_size
+        self.overflow_policy = overflow_policy
+        self.max_batch_bytes = max_batch_bytes
+        self._reset()
+
+    def _reset(self):
+        # All state shared with the drain thread uses native locks, so this
+        # works whether or not the threading module is monkeypatched.
+        threading = self._threading = native_threading()
+        self._pid = os.getpid()
+        self._queue = collections.deque()
+        self._queued_debug = 0
+        self._mutex = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._wakeup = threading.Lock()
+        self._wakeup.acquire()
+        self._waiting = False
+        self._started = False
+        self._closed = False
+        self.dropped_records = collections.Counter()
+        self.written_records = 0
+        self.write_errors = 0
+
+    def stats(self):
+        """Return counters describing the handler's state."""
+        return {'queued': len(self._queue),
+                'written': self.written_records,
+                'dropped': sum(self.dropped_records.values()),
+                'dropped_by_level': dict(self.dropped_records),
+                'write_errors': self.write_errors}
+
+    def emit(self, record):
+        try:
+            msg = self.format(record)
+        except Exception:
+            self.handleError(record)
+            return
+        if os.getpid() != self._pid:
+            self._reset()
+        self._enqueue(record.levelno, msg)
+
+    def _enqueue(self, levelno, msg):
+        while not self._try_enqueue(levelno, msg):
+            # Only with the 'block' policy. Uses the (possibly monkeypatched)
+            # time.sleep rather than waiting on a native lock, so that under
+            # gevent other greenlets can keep running.
+            time.sleep(0.001)
+
+    def _try_enqueue(self, levelno, msg):
+        """Queue a record, applying the overflow policy. Returns False if
+        the caller should wait for room and try again. Checking for room and
+        appending happen under the same mutex, so that concurrent producers
+        can't both take the last slot."""
+        with self._mutex:
+            if len(self._queue) >= self.max_queue_size:
+                if self.overflow_policy == BLOCK and self._started and \
+                        not self._closed:
+                    return False
+                if not self._make_room(levelno):
+                    self.dropped_records[logging.getLevelName(levelno)] += 1
+                    return True
+            self._queue.append((levelno, msg))
+            if levelno <= logging.DEBUG:
+                self._queued_debug += 1
+            if not self._started:
+                self._started = True
+                self._threading.start_new_thread(self._drain_thread, ())
+            if self._waiting:
+                self._waiting = False
+                self._wakeup.release()
+            return True
+
+    def _make_room(self, levelno):
+        """Free up a slot in the full queue. Returns False if the incoming
+        record should be dropped instead. Must be called with the mutex
+        held."""
+        queue = self._queue
+        if self.overflow_policy == DROP_DEBUG_FIRST:
+            if levelno <= logging.DEBUG:
+                return False
+            if self._queued_debug:
+                for i, (queued_levelno, _) in enumerate(queue):
+                    if queued_levelno <= logging.DEBUG:
+                        del queue[i]
+                        self._queued_debug -= 1
+                        self.dropped_records['DEBUG'] += 1
+                        return True
+        dropped_levelno, _ = queue.popleft()
+        if dropped_levelno <= logging.DEBUG:
+            self._queued_debug -= 1
+        self.dropped_records[logging.getLevelName(dropped_levelno)] += 1
+        return True
+
+    def _pop_batch(self):
+        """Pop queued messages up to max_batch_bytes. Must be called with the
+        mutex held."""
+        queue = self._queue
+        batch = []
+        size = 0
+        while queue and size < self.max_batch_bytes:
+            levelno, msg = queue.popleft()
+            if levelno <= logging.DEBUG:
+                self._queued_debug -= 1
+            batch.append(msg)
+            size += len(msg) + 1
+        return batch
+
+    def _write_batches(self):
+        """Write out everything that is currently queued."""
+        with self._write_lock:
+            while True:
+                with self._mutex:
+                    batch = self._pop_batch()
+                if not batch:
+                    return
+                batch.append('')
+                try:
+                    self.stream.write('\n'.join(batch))
+                    self.stream.flush()
+                    self.written_records += len(batch) - 1
+                except Exception:
+                    self.write_errors += 1
+
+    def _drain_thread(self):
+        pid = self._pid
+        try:
+            while os.getpid() == pid:
+                with self._mutex:
+                    if self._closed and not self._queue:
+                        return
+                    wait = not self._queue
+                    if wait:
+                        self._waiting = True
+                if wait:
+                    self._wakeup.acquire()
+                self._write_batches()
+        # Swallow exceptions raised during interpreter shutdown.
+        except Exception:
+            if sys is not None:
+                raise
+
+    def flush(self):
+        """Synchronously write out all queued records."""
+        self._write_batches()
+
+    def close(self):
+        with self._mutex:
+            self._closed = True
+            if self._waiting:
+                self._waiting = False
+                self._wakeup.release()
+        self.flush()
+        logging.Handler.close(self)
+
+
+class BufferedStreamHandler(logging.Handler):
+    """Handler that joins formatted records into larger writes to `stream`.
+
+    Buffered records are written out once they add up to `max_buffer_bytes`,
+    when a record at `flush_level` or above comes in, or at the latest
+    `max_latency` seconds after the first buffered record, by way of a timer
+    on the gevent hub. All writes happen on the calling thread (records
+    logged from threads other than the one that created the handler are
+    written out immediately, since the timer belongs to its hub). In a
+    forked child, records buffered by the parent are discarded, since the
+    parent still owns them.
+
+    Parameters
+    ----------
+    stream: file-like, optional
+        Where to write. Defaults to sys.stdout.
+    max_buffer_bytes: int
+    max_latency: float
+    flush_level: int
+    """
+    def __init__(self, stream=None, max_buffer_bytes=MAX_BATCH_BYTES,
+                 max_latency=MAX_BUFFER_LATENCY, flush_level=logging.ERROR):
+        logging.Handler.__init__(self)
+        self.stream = stream or sys.stdout
+        self.max_buffer_bytes = max_buffer_bytes
+        self.max_latency = max_latency
+        self.flush_level = flush_level
+        self.write_errors = 0
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._get_thread_ident = thread_ident_function()
+        self._thread_ident = self._get_thread_ident()
+        self._buffer = []
+        self._buffered_bytes = 0
+        self._timer = None
+
+    def emit(self, record):
+        try:
+            msg = self.format(record)
+        except Exception:
+            self.handleError(record)
+            return
+        if os.getpid() != self._pid:
+            self._reset()
+        self._buffer.append(msg + '\n')
+        self._buffered_bytes += len(msg) + 1
+        if record.levelno >= self.flush_level or \
+                self._buffered_bytes >= self.max_buffer_bytes or \
+                self._get_thread_ident() != self._thread_ident:
+            self.flush()
+        elif len(self._buffer) == 1:
+            self._schedule_flush()
+
+    def _schedule_flush(self):
+        if self._timer is None:
+            import gevent
+            self._timer = gevent.get_hub().loop.timer(self.max_latency)
+            # Don't keep the event loop alive just to flush logs.
+            self._timer.ref = False
+        if not self._timer.active:
+            self._timer.start(self.flush)
+
+    def flush(self):
+        self.acquire()
+        try:
+            if not self._buffer:
+                return
+            data = ''.join(self._buffer)
+            self._buffer = []
+            self._buffered_bytes = 0
+            try:
+                self.stream.write(data)
+                self.stream.flush()
+            except Exception:
+                self.write_errors += 1
+        finally:
+            self.release()
+
+    def close(self):
+        self.flush()
+        if self._timer is not None:
+            self._timer.stop()
+        logging.Handler.close(self)
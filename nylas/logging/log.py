@@ -5,22 +5,44 @@ Logging configuration.
 Mostly based off http://www.structlog.org/en/16.1.0/standard-library.html.
 
 """
-import re
 import os
 import sys
 import traceback
 import logging
 import logging.handlers
 
-import gevent
-import colorlog
 import structlog
+from greenlet import getcurrent
 
 from structlog.threadlocal import wrap_dict
 
+from nylas.logging.handlers import (AsyncStreamHandler, BufferedStreamHandler,
+                                    DROP_OLDEST, MAX_QUEUE_SIZE)
+from nylas.logging.context import merge_request_context
+from nylas.logging.fingerprint import TracebackCache
+from nylas.logging.renderers import JSONRenderer
+from nylas.logging.timestamps import make_timestamper, ISO
+
 
 MAX_EXCEPTION_LENGTH = 10000
 
+# Formatted tracebacks, keyed by fingerprint.
+_traceback_cache = TracebackCache()
+
+
+# Modules whose frames are skipped when looking for the code that issued a
+# log call.
+IGNORED_MODULE_PREFIXES = ('structlog', 'nylas.logging',
+                           'inbox.sqlalchemy_ext.util', 'inbox.models.session',
+                           'sqlalchemy', 'gunicorn.glogging')
+
+# Upper bound on the number of code objects whose ignorability we remember.
+MAX_FRAME_CACHE_SIZE = 10000
+
+_ignored_module_prefixes = IGNORED_MODULE_PREFIXES
+# Maps code objects to whether frames running them are ignorable.
+_ignorable_code_cache = {}
+
 
 def find_first_app_frame_and_name(ignores=None):
     """
@@ -37,16 +59,76 @@ def find_first_app_frame_and_name(ignores=None):
     -------
     tuple of (frame, name)
     """
-    ignores = ignores or []
+    ignores = tuple(ignores or ())
     f = sys._getframe()
     name = f.f_globals.get('__name__')
     while f is not None and f.f_back is not None and \
-            (name is None or any(name.startswith(i) for i in ignores)):
+            (name is None or name.startswith(ignores)):
         f = f.f_back
         name = f.f_globals.get('__name__')
     return f, name
 
 
+def _find_app_frame():
+    """Like find_first_app_frame_and_name(IGNORED_MODULE_PREFIXES) (plus
+    any prefixes registered through configure_logging), but remembers per
+    code object whether its frames are ignorable, so that each frame costs a
+    single dict lookup."""
+    cache = _ignorable_code_cache
+    f = sys._getframe()
+    while f.f_back is not None:
+        code = f.f_code
+        ignorable = cache.get(code)
+        if ignorable is None:
+            name = f.f_globals.get('__name__')
+            ignorable = name is None or \
+                name.startswith(_ignored_module_prefixes)
+            if len(cache) >= MAX_FRAME_CACHE_SIZE:
+                cache.clear()
+            cache[code] = ignorable
+        if not ignorable:
+            break
+        f = f.f_back
+    return f
+
+
+def _set_ignored_module_prefixes(extra_prefixes):
+    global _ignored_module_prefixes
+    _ignored_module_prefixes = (IGNORED_MODULE_PREFIXES +
+                                tuple(extra_prefixes or ()))
+    _ignorable_code_cache.clear()
+
+
+# Set by configure_logging().
+_rate_limiter = None
+
+SUPPRESSED_EVENTS_SUMMARY = 'log events suppressed'
+
+# Returns the current time for the `timestamp` field. Set by
+# configure_logging().
+_timestamp = make_timestamper(ISO)
+
+
+def _record_timestamp(logger, name, event_dict):
+    """Processor that records the current time (by default as an ISO 8601
+    UTC string)."""
+    event_dict['timestamp'] = _timestamp()
+    return event_dict
+
+
+def _format_stack(frame):
+    return ('Stack (most recent call last):\n' +
+            ''.join(traceback.format_stack(frame))[:-1])
+
+
+def _record_stack(logger, name, event_dict):
+    """Processor that adds a dump of the stack leading to the logging call if
+    `stack_info` is true."""
+    if event_dict.pop('stack_info', None):
+        event_dict['stack'] = _format_stack(_find_app_frame())
+    return event_dict
+
+
 def _record_level(logger, name, event_dict):
     """Processor that records the log level ('info', 'warning', etc.) in the
     structlog event dictionary."""
@@ -54,34 +136,71 @@ def _record_level(logger, name, event_dict):
     return event_dict
 
 
+def _caller_module():
+    f = _find_app_frame()
+    return '{}:{}'.format(f.f_globals.get('__name__'), f.f_lineno)
+
+
 def _record_module(logger, name, event_dict):
     """Processor that records the module and line where the logging call was
     invoked."""
-    f, name = find_first_app_frame_and_name(
-        ignores=['structlog', 'nylas.logging', 'inbox.sqlalchemy_ext.util',
-                 'inbox.models.session', 'sqlalchemy', 'gunicorn.glogging'])
-    event_dict['module'] = '{}:{}'.format(name, f.f_lineno)
+    event_dict['module'] = _caller_module()
+    return event_dict
+
+
+def _rate_limit(logger, name, event_dict):
+    """Processor that drops events which exceed the limits of the configured
+    RateLimiter, and logs a summary of how many events it dropped once each
+    summary interval is over."""
+    limiter = _rate_limiter
+    if limiter is None or 'suppressed_count' in event_dict:
+        # Either not configured, or one of our own summaries.
+        return event_dict
+    event = event_dict.get('event')
+    # Only look up the calling module, which is relatively slow, for events
+    # that are limited at all.
+    allowed = limiter.limit_for(event, name) is None or \
+        limiter.allow(event, _caller_module(), name)
+    for (event, module, level), count in limiter.pop_summaries():
+        get_logger().warning(SUPPRESSED_EVENTS_SUMMARY,
+                             suppressed_event=event,
+                             suppressed_module=module,
+                             suppressed_level=level,
+                             suppressed_count=count)
+    if not allowed:
+        raise structlog.DropEvent
     return event_dict
 
 
 def safe_format_exception(etype, value, tb, limit=None):
     """Similar to structlog._format_exception, but truncate the exception part.
     This is because SQLAlchemy exceptions can sometimes have ludicrously large
-    exception strings."""
+    exception strings.
+
+    Unless `limit` is given, the traceback part is looked up in (or added
+    to) the traceback cache, since the same failure tends to be formatted
+    many times over."""
     if tb:
-        list = ['Traceback (most recent call last):\n']
-        list = list + traceback.format_tb(tb, limit)
+        if limit is None:
+            formatted_tb = _traceback_cache.lookup(etype, tb).formatted_tb
+        else:
+            formatted_tb = ''.join(traceback.format_tb(tb, limit))
+        return _format_exception(etype, value, formatted_tb)
     elif etype and value:
-        list = []
-    else:
-        return None
+        return _format_exception(etype, value, None)
+    return None
+
+
+def _format_exception(etype, value, formatted_tb):
     exc_only = traceback.format_exception_only(etype, value)
     # Normally exc_only is a list containing a single string.  For syntax
     # errors it may contain multiple elements, but we don't really need to
     # worry about that here.
     exc_only[0] = exc_only[0][:MAX_EXCEPTION_LENGTH]
-    list = list + exc_only
-    return ''.join(list)
+    if formatted_tb is None:
+        return ''.join(exc_only)
+    return ('Traceback (most recent call last):\n' + formatted_tb +
+            ''.join(exc_only))
 
 
 def _is_log_in_same_fn_scope(exc_tb):
@@ -99,20 +218,15 @@ def _is_log_in_same_fn_scope(exc_tb):
 
     The default behavior we want, however, is only logging exceptions if
     the user is inside or immediately next to the frame to log. This
-    detects of the log statement and the exception share the same
-    function.
+    detects if the log statement and the exception share the same
+    function, by looking for the code object of the frame that made the log
+    call among the frames of the traceback. No source is read.
     """
-    cur_stack = traceback.extract_stack()
-    calling_fn = None
-    for fname, line_num, fn_name, code in reversed(cur_stack):
-        if code and re.search("log\.(error|exception)", code):
-            calling_fn = fn_name
-            break
-
-    exc_tb_stack = traceback.extract_tb(exc_tb)
-    for fname, line_num, fn_name, code in exc_tb_stack:
-        if fn_name == calling_fn:
+    calling_code = _find_app_frame().f_code
+    while exc_tb is not None:
+        if exc_tb.tb_frame.f_code is calling_code:
             return True
+        exc_tb = exc_tb.tb_next
     return False
 
 
@@ -173,9 +287,22 @@ def _safe_exc_info_renderer(_, __, event_dict):
         exc_info = (None, None, None)
 
     event_dict.update(create_error_log_context(exc_info))
+    _collapse_repeated_traceback(event_dict)
     return event_dict
 
 
+def _collapse_repeated_traceback(event_dict):
+    """If a traceback repeats within the configured window, replace it with
+    the number of repeats. Its `error_fingerprint` identifies it."""
+    if 'error_traceback' not in event_dict or \
+            'error_fingerprint' not in event_dict:
+        return
+    repeats = _traceback_cache.count_repeat(event_dict['error_fingerprint'])
+    if repeats:
+        del event_dict['error_traceback']
+        event_dict['error_repeat_count'] = repeats
+
+
 def _safe_encoding_renderer(_, __, event_dict):
     """Processor that converts all strings to unicode.
        Note that we ignore conversion errors.
@@ -189,38 +316,156 @@ def _safe_encoding_renderer(_, __, event_dict):
     return event_dict
 
 
+# Numeric level of each BoundLogger method name.
+_METHOD_LEVELS = {'debug': logging.DEBUG,
+                  'info': logging.INFO,
+                  'warning': logging.WARNING,
+                  'error': logging.ERROR,
+                  'exception': logging.ERROR,
+                  'critical': logging.CRITICAL}
+
+# 'prod', 'staging', 'dev' ... Re-read by configure_logging().
+_env = os.environ.get('NYLAS_ENV')
+
 class BoundLogger(structlog.stdlib.BoundLogger):
-    """ BoundLogger which always adds greenlet_id and env to positional args """
+    """ BoundLogger which always adds greenlet_id and env to positional args,
+    and drops calls for disabled levels before doing any other work. """
 
     def _proxy_to_logger(self, method_name, event, *event_args, **event_kw):
-        event_kw['greenlet_id'] = id(gevent.getcurrent())
+        # Not try/except: on Python 2, handling an exception here would
+        # replace the sys.exc_info() that the processors report.
+        level = _METHOD_LEVELS.get(method_name)
+        if level is not None and not self._logger.isEnabledFor(level):
+            return None
 
-        # 'prod', 'staging', 'dev' ...
-        env = os.environ.get('NYLAS_ENV')
-        if env is not None:
-            event_kw['env'] = env
+        event_kw['greenlet_id'] = id(getcurrent())
+
+        if _env is not None:
+            event_kw['env'] = _env
 
         return super(BoundLogger, self)._proxy_to_logger(
                 method_name, event, *event_args, **event_kw)
 
 
-structlog.configure(
-    processors=[
-        structlog.stdlib.filter_by_level,
-        structlog.processors.TimeStamper(fmt='iso', utc=True),
-        structlog.processors.StackInfoRenderer(),
+def _render_exc_info_and_encode(logger, name, event_dict):
+    """The work of _safe_exc_info_renderer and _safe_encoding_renderer, for
+    the fused processors."""
+    # Skip _safe_exc_info_renderer when it would leave the event unchanged.
+    if name == 'error' or 'error' in event_dict or \
+            'exc_info' in event_dict or 'include_exception' in event_dict or \
+            'error_fingerprint' in event_dict:
+        _safe_exc_info_renderer(logger, name, event_dict)
+    for key, entry in event_dict.iteritems():
+        if isinstance(entry, str):
+            event_dict[key] = unicode(entry, encoding='utf-8',
+                                      errors='replace')
+
+
+def _fused_processor(logger, name, event_dict):
+    """Processor that does the work of the filter_by_level,
+    merge_request_context, _record_timestamp, _record_stack, _record_level,
+    _safe_exc_info_renderer, _safe_encoding_renderer and _record_module
+    processors in a single call, with identical results."""
+    if not logger.isEnabledFor(_METHOD_LEVELS[name]):
+        raise structlog.DropEvent
+    merge_request_context(logger, name, event_dict)
+    event_dict['timestamp'] = _timestamp()
+    if 'stack_info' in event_dict:
+        _record_stack(logger, name, event_dict)
+    event_dict['level'] = name
+    _render_exc_info_and_encode(logger, name, event_dict)
+    event_dict['module'] = _caller_module()
+    return event_dict
+
+
+def _fast_processor(logger, name, event_dict):
+    """Processor for the 'prod-fast' profile. Like _fused_processor, but
+    doesn't look up the calling module or record stacks, and leaves level
+    filtering to BoundLogger."""
+    merge_request_context(logger, name, event_dict)
+    event_dict['timestamp'] = _timestamp()
+    event_dict['level'] = name
+    _render_exc_info_and_encode(logger, name, event_dict)
+    return event_dict
+
+
+PROFILE_PROD_FAST = 'prod-fast'
+PROFILE_DEFAULT = 'default'
+PROFILE_DEBUG = 'debug'
+PROFILES = (PROFILE_PROD_FAST, PROFILE_DEFAULT, PROFILE_DEBUG)
+
+# Processor chains are built once per profile and set of options.
+_processor_chains = {}
+
+
+def _build_processors(json_serializer=None, fused=False, rate_limited=False,
+                      profile=PROFILE_DEFAULT, console=False):
+    key = (profile, json_serializer, fused, rate_limited, console)
+    chain = _processor_chains.get(key)
+    if chain is None:
+        chain = _processor_chains[key] = _make_processors(*key)
+    return list(chain)
+
+
+def _make_processors(profile, json_serializer, fused, rate_limited,
+                     console):
+    # Rate limiting comes first, so that dropped events skip the more
+    # expensive processors. In the fused pipelines it comes before level
+    # filtering too, which is fine since BoundLogger filters levels itself.
+    rate_limit = [_rate_limit] if rate_limited else []
+    if console:
+        renderer = structlog.processors.KeyValueRenderer(
+            key_order=['timestamp', 'level', 'event'])
+    else:
+        renderer = JSONRenderer(serializer=json_serializer)
+    if profile == PROFILE_PROD_FAST:
+        return rate_limit + [_fast_processor, renderer]
+    if fused:
+        return rate_limit + [_fused_processor, renderer]
+    return [structlog.stdlib.filter_by_level] + rate_limit + [
+        merge_request_context,
+        _record_timestamp,
+        _record_stack,
         _record_level,
         _safe_exc_info_renderer,
         _safe_encoding_renderer,
         _record_module,
-        structlog.processors.JSONRenderer(),
-    ],
-    context_class=wrap_dict(dict),
-    logger_factory=structlog.stdlib.LoggerFactory(),
-    wrapper_class=BoundLogger,
-    cache_logger_on_first_use=True,
-)
-get_logger = structlog.get_logger
+        renderer,
+    ]
+
+
+# Loggers that structlog has cached hold on to this list, so
+# configure_logging() updates it in place rather than calling
+# structlog.configure() again, which would leave loggers cached under the
+# previous profile with the previous chain.
+_processors = []
+_structlog_configured = False
+
+
+def _configure_structlog():
+    """Configure structlog with the default processor chain, unless that
+    was done already. Deferred to the first get_logger() or
+    configure_logging() call, so that importing this module doesn't
+    override an app's own structlog configuration."""
+    global _structlog_configured
+    if _structlog_configured:
+        return
+    _structlog_configured = True
+    _processors[:] = _build_processors()
+    structlog.configure(
+        processors=_processors,
+        context_class=wrap_dict(dict),
+        logger_factory=structlog.stdlib.LoggerFactory(),
+        wrapper_class=BoundLogger,
+        cache_logger_on_first_use=True,
+    )
+
+
+def get_logger(*args, **initial_values):
+    """Return a structlog logger, configuring structlog first if needed.
+    Arguments are passed to structlog.get_logger."""
+    _configure_structlog()
+    return structlog.get_logger(*args, **initial_values)
 
 # Convenience map to let users set level with a string
 LOG_LEVELS = {"debug": logging.DEBUG,
@@ -235,7 +480,14 @@ def json_excepthook(etype, value, tb):
     log.error(**create_error_log_context((etype, value, tb)))
 
 
-def configure_logging(log_level=None):
+def configure_logging(log_level=None, async_output=False,
+                      max_queue_size=MAX_QUEUE_SIZE,
+                      overflow_policy=DROP_OLDEST, buffered_output=False,
+                      ignore_module_prefixes=None,
+                      traceback_repeat_window=None,
+                      json_serializer=None, fused_processors=False,
+                      timestamp_format=ISO, rate_limiter=None,
+                      profile=PROFILE_DEFAULT):
     """ Idempotently configure logging.
 
     Infers options based on whether or not the output is a TTY.
@@ -245,8 +497,70 @@ def configure_logging(log_level=None):
     Overrides top-level exceptions to also print as JSON, rather than
     printing to stderr as plaintext.
 
+    If `async_output` is set, records are handed off to an
+    `AsyncStreamHandler` which writes them from a separate OS thread, so a
+    slow stdout can't block the event loop. `max_queue_size` and
+    `overflow_policy` are passed through to the handler.
+
+    If `buffered_output` is set instead, records are written by a
+    `BufferedStreamHandler`, which joins them into fewer, larger writes but
+    writes out errors immediately.
+
+    `ignore_module_prefixes` lists modules, in addition to
+    IGNORED_MODULE_PREFIXES, whose frames should not be reported as the
+    `module` that issued a log call (e.g. an app's own logging helpers).
+
+    Error events carry an `error_fingerprint` identifying where the error
+    came from. If `traceback_repeat_window` is set, an error that repeats
+    within that many seconds is logged with its fingerprint and an
+    `error_repeat_count` instead of the full `error_traceback`.
+
+    `json_serializer` names the encoder used to render events (one of
+    nylas.logging.renderers.SERIALIZERS), or is a function that renders the
+    event dict itself.
+
+    If `fused_processors` is set, the processors that enrich each event are
+    replaced by a single one which produces the same output with less
+    per-event overhead.
+
+    `timestamp_format` is 'iso' for ISO 8601 strings, or 'epoch' or
+    'epoch_ms' for float seconds or integer milliseconds since the epoch.
+
+    `rate_limiter` is an optional nylas.logging.ratelimit.RateLimiter. Events
+    over its limits are dropped, and summarized in a 'log events suppressed'
+    warning once the limiter's summary interval is over. Summaries are
+    emitted while logging a later event, so those of a process that stops
+    logging altogether are never emitted.
+
+    `profile` picks the processor chain: 'default' as described above,
+    'prod-fast' for high-volume services (no `module` or `stack_info`
+    lookups, and a single processor before rendering), or 'debug', which
+    defaults to the DEBUG level, always logs full tracebacks and renders
+    events as key=value pairs on a TTY. Switching profiles applies to
+    loggers that were already created too.
+
+    Log calls below a logger's effective level return before any processing.
+
     """
+    global _env, _timestamp, _rate_limiter
+    if async_output and buffered_output:
+        raise ValueError('async_output and buffered_output are exclusive')
+    if profile not in PROFILES:
+        raise ValueError('Unknown logging profile {!r}'.format(profile))
+    if profile == PROFILE_DEBUG:
+        traceback_repeat_window = None
+        if log_level is None:
+            log_level = logging.DEBUG
     sys.excepthook = json_excepthook
+    _timestamp = make_timestamper(timestamp_format)
+    _rate_limiter = rate_limiter
+    _env = os.environ.get('NYLAS_ENV')
+    _configure_structlog()
+    _processors[:] = _build_processors(
+        json_serializer, fused_processors, rate_limiter is not None, profile,
+        console=profile == PROFILE_DEBUG and sys.stdout.isatty())
+    _set_ignored_module_prefixes(ignore_module_prefixes)
+    _traceback_cache.repeat_window = traceback_repeat_window
 
     # Set loglevel INFO if not otherwise specified. (We don't set a
     # default in the case that you're loading a value from a config and
@@ -256,9 +570,18 @@ def configure_logging(log_level=None):
     elif log_level in LOG_LEVELS:
         log_level = LOG_LEVELS[log_level]
 
-    tty_handler = logging.StreamHandler(sys.stdout)
+    if async_output:
+        tty_handler = AsyncStreamHandler(sys.stdout,
+                                         max_queue_size=max_queue_size,
+                                         overflow_policy=overflow_policy)
+    elif buffered_output:
+        tty_handler = BufferedStreamHandler(sys.stdout)
+    else:
+        tty_handler = logging.StreamHandler(sys.stdout)
     if sys.stdout.isatty():
-        # Use a more human-friendly format.
+        # Use a more human-friendly format. Imported here since it's only
+        # needed in this case.
+        import colorlog
         formatter = colorlog.ColoredFormatter(
             '%(log_color)s[%(levelname)s]%(reset)s %(message)s',
             reset=True, log_colors={'DEBUG': 'cyan', 'INFO': 'green',
@@ -271,15 +594,24 @@ def configure_logging(log_level=None):
 
     # Configure the root logger.
     root_logger = logging.getLogger()
-    for handler in root_logger.handlers:
+    for handler in list(root_logger.handlers):
         # If the handler was previously installed, remove it so that repeated
         # calls to configure_logging() are idempotent.
         if getattr(handler, '_nylas', False):
             root_logger.removeHandler(handler)
+            handler.close()
     root_logger.addHandler(tty_handler)
     root_logger.setLevel(log_level)
 
 
+def flush_logging():
+    """Write out any records buffered by the handlers that configure_logging()
+    installed. Call this before a worker process exits."""
+    for handler in logging.getLogger().handlers:
+        if getattr(handler, '_nylas', False):
+            handler.flush()
+
+
 def create_error_log_context(exc_info):
     exc_type, exc_value, exc_tb = exc_info
     out = dict()
@@ -300,9 +632,10 @@ def create_error_log_context(exc_info):
 
     try:
         if exc_tb:
-            tb = safe_format_exception(exc_type, exc_value, exc_tb)
-            if tb:
-                out['error_traceback'] = tb
+            entry = _traceback_cache.lookup(exc_type, exc_tb)
+            out['error_fingerprint'] = entry.digest
+            out['error_traceback'] = _format_exception(exc_type, exc_value,
+                                                       entry.formatted_tb)
     except:
         pass
 
@@ -0,0 +1,112 @@
+"""
+Rate limiting of repetitive log events.
+
+"""
+import time
+import collections
+
+from nylas.logging.suppression import SuppressionWindows
+from nylas.util.threads import native_threading
+
+
+SUMMARY_INTERVAL = 60
+MAX_KEYS = 10000
+
+
+class _KeyState(object):
+    __slots__ = ('tokens', 'last_time', 'suppressed', 'window_start')
+
+    def __init__(self, tokens, now):
+        self.tokens = tokens
+        self.last_time = now
+        self.suppressed = 0
+        self.window_start = None
+
+
+class RateLimiter(object):
+    """Token-bucket rate limiting of log events, keyed on (event, module,
+    level). Each key gets its own bucket, which holds up to `burst` tokens
+    and refills at `rate` tokens per second; an event is let through if it
+    can take a token.
+
+    Counts of suppressed events are kept per key, and handed out by
+    `pop_summaries` once `summary_interval` seconds have passed since the
+    first suppression. Buckets are kept in an LRU of at most `max_keys`
+    entries; pending counts of evicted keys are summarized right away.
+
+    Limits are (rate, burst) tuples. The most specific one applies: an entry
+    of `event_limits` keyed on the event name, then an entry of
+    `level_limits` keyed on the level name, then `default_limit`. Events
+    without a limit are always let through.
+
+    Parameters
+    ----------
+    default_limit: tuple, optional
+    level_limits: dict, optional
+    event_limits: dict, optional
+    summary_interval: float
+    max_keys: int
+    clock: callable, optional
+        Returns the current time in seconds.
+    """
+    def __init__(self, default_limit=None, level_limits=None,
+                 event_limits=None, summary_interval=SUMMARY_INTERVAL,
+                 max_keys=MAX_KEYS, clock=time.time):
+        self.default_limit = default_limit
+        self.level_limits = level_limits or {}
+        self.event_limits = event_limits or {}
+        self.summary_interval = summary_interval
+        self.max_keys = max_keys
+        self.clock = clock
+        self.total_suppressed = 0
+        self._buckets = collections.OrderedDict()
+        self._windows = SuppressionWindows(summary_interval)
+        # Events can be logged from other OS threads, e.g. by Tracer.
+        self._lock = native_threading().Lock()
+
+    def limit_for(self, event, level):
+        limit = self.event_limits.get(event)
+        if limit is None:
+            limit = self.level_limits.get(level, self.default_limit)
+        return limit
+
+    def allow(self, event, module, level):
+        """Return whether an event should be logged, and record it as
+        suppressed if not."""
+        limit = self.limit_for(event, level)
+        if limit is None:
+            return True
+        rate, burst = limit
+        key = (event, module, level)
+        now = self.clock()
+        with self._lock:
+            state = self._buckets.pop(key, None)
+            if state is None:
+                state = _KeyState(burst, now)
+            else:
+                state.tokens = min(burst, state.tokens +
+                                   (now - state.last_time) * rate)
+                state.last_time = now
+            self._buckets[key] = state
+            if len(self._buckets) > self.max_keys:
+                self._windows.evict(self._buckets.popitem(last=False)[0])
+
+            if state.tokens >= 1:
+                state.tokens -= 1
+                return True
+            if not state.suppressed:
+                state.window_start = now
+            self._windows.suppress(key, state)
+            self.total_suppressed += 1
+            return False
+
+    def pop_summaries(self):
+        """Return a list of ((event, module, level), suppressed count) for
+        keys whose summary interval has passed, and reset their counts.
+        See SuppressionWindows.pop_summaries."""
+        now = self.clock()
+        # Checked without the lock first, since this runs for every event.
+        if not self._windows.due(now):
+            return []
+        with self._lock:
+            return self._windows.pop_summaries(now)
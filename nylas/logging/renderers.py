@@ -0,0 +1,112 @@
+"""
+JSON rendering of structlog event dicts.
+
+"""
+import json
+import datetime
+
+
+def _encode_exception(exc):
+    try:
+        message = str(exc)
+    except Exception:
+        return repr(exc)
+    name = type(exc).__name__
+    if not message:
+        return name
+    return '{}: {}'.format(name, message).decode('utf-8', 'replace')
+
+
+def _encode_bytearray(value):
+    return str(value).decode('utf-8', 'replace')
+
+
+def _encode_memoryview(value):
+    return value.tobytes().decode('utf-8', 'replace')
+
+
+def _encode_datetime(value):
+    return value.isoformat()
+
+
+# Encoders for types the json module doesn't know about. Subclasses are
+# resolved through their MRO and then cached in _encoders_by_type.
+_ENCODERS = {
+    datetime.datetime: _encode_datetime,
+    datetime.date: _encode_datetime,
+    datetime.time: _encode_datetime,
+    set: list,
+    frozenset: list,
+    bytearray: _encode_bytearray,
+    memoryview: _encode_memoryview,
+    BaseException: _encode_exception,
+}
+_encoders_by_type = dict(_ENCODERS)
+
+
+def _fallback_encoder(obj):
+    try:
+        return obj.__structlog__()
+    except AttributeError:
+        return repr(obj)
+
+
+def _default(obj):
+    """`default` hook for the JSON encoders."""
+    cls = type(obj)
+    encoder = _encoders_by_type.get(cls)
+    if encoder is None:
+        encoder = _fallback_encoder
+        for base in getattr(cls, '__mro__', ()):
+            if base in _ENCODERS:
+                encoder = _ENCODERS[base]
+                break
+        _encoders_by_type[cls] = encoder
+    return encoder(obj)
+
+
+def _json_serializer():
+    return json.JSONEncoder(check_circular=False, default=_default).encode
+
+
+def _simplejson_serializer():
+    import simplejson
+    return simplejson.JSONEncoder(check_circular=False, default=_default,
+                                  namedtuple_as_object=False).encode
+
+
+SERIALIZERS = {
+    'json': _json_serializer,
+    'simplejson': _simplejson_serializer,
+}
+
+
+# With a prebuilt encoder, the stdlib's C speedups outperform simplejson's
+# (see benchmarks/bench_json_renderer.py).
+DEFAULT_SERIALIZER = 'json'
+
+
+class JSONRenderer(object):
+    """Processor that renders the event dict as JSON. Like
+    structlog.processors.JSONRenderer, but builds its encoder once instead
+    of on every event, and encodes datetimes, sets, bytearrays and
+    exceptions directly instead of falling back to repr().
+
+    Parameters
+    ----------
+    serializer: str or callable, optional
+        Name of one of SERIALIZERS, or a function that takes the event dict
+        and returns a string. Defaults to DEFAULT_SERIALIZER.
+    """
+    def __init__(self, serializer=None):
+        if serializer is None:
+            serializer = DEFAULT_SERIALIZER
+        if callable(serializer):
+            self.serializer = serializer
+        elif serializer in SERIALIZERS:
+            self.serializer = SERIALIZERS[serializer]()
+        else:
+            raise ValueError('Unknown JSON serializer {!r}'.format(serializer))
+
+    def __call__(self, logger, name, event_dict):
+        return self.serializer(event_dict)
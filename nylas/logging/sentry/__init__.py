@@ -1,18 +1,34 @@
 import os
 import sys
+import atexit
 from urllib2 import URLError
 from pkgutil import extend_path
 
 # Allow out-of-tree submodules.
 __path__ = extend_path(__path__, __name__)
 
-import raven
-import raven.processors
-
 from nylas.logging.log import (get_logger, create_error_log_context,
                                MAX_EXCEPTION_LENGTH)
+from nylas.logging.sentry.sampling import FingerprintSampler
 
 _sentry_client = None
+_async_delivery = None
+_sampler = None
+
+SUPPRESSED_EXCEPTIONS_SUMMARY = 'Suppressed repeated exceptions'
+
+# Limits applied by TruncatingProcessor. Sizes are in characters, and the
+# payload size is estimated from the length of strings and keys.
+MAX_PAYLOAD_SIZE = 256 * 1024
+MAX_STRING_LENGTH = 2048
+MAX_FRAMES = 50
+MAX_LOCALS_DEPTH = 3
+MAX_BREADCRUMBS = 50
+TRIMMED = '[trimmed]'
+
+# Top-level event keys that TruncatingProcessor trims in their own way.
+_SPECIAL_KEYS = frozenset(('exception', 'message', 'tags', 'extra',
+                           'breadcrumbs'))
 
 
 def sentry_exceptions_enabled():
@@ -22,29 +38,228 @@ def sentry_exceptions_enabled():
 def get_sentry_client():
     global _sentry_client
     if _sentry_client is None:
+        # raven is slow to import, and only needed once Sentry is used.
+        import raven
         _sentry_client = raven.Client(
             processors=('nylas.logging.sentry.TruncatingProcessor',))
     return _sentry_client
 
 
-class TruncatingProcessor(raven.processors.Processor):
-    """Truncates the exception value string"""
+class _Trimmer(object):
+    """Copies event data, truncating strings and nested structures, within a
+    budget for the total size."""
+    def __init__(self, budget):
+        self.remaining = budget
+        self.trimmed_chars = 0
+        self.trimmed_items = 0
+        self.trimmed_frames = 0
+
+    def trim(self, value, max_depth, max_length=MAX_STRING_LENGTH):
+        if isinstance(value, basestring):
+            limit = max(0, min(max_length, self.remaining))
+            if len(value) > limit:
+                self.trimmed_chars += len(value) - limit
+                value = value[:limit]
+            self.remaining -= len(value)
+            return value
+        if isinstance(value, dict):
+            if max_depth <= 0:
+                self.trimmed_items += 1
+                return TRIMMED
+            trimmed = {}
+            for key, item in value.iteritems():
+                if self.remaining <= 0:
+                    self.trimmed_items += len(value) - len(trimmed)
+                    break
+                self.remaining -= len(key) if isinstance(key, basestring) \
+                    else 8
+                trimmed[key] = self.trim(item, max_depth - 1, max_length)
+            return trimmed
+        if isinstance(value, (list, tuple)):
+            if max_depth <= 0:
+                self.trimmed_items += 1
+                return TRIMMED
+            trimmed = []
+            for item in value:
+                if self.remaining <= 0:
+                    self.trimmed_items += len(value) - len(trimmed)
+                    break
+                trimmed.append(self.trim(item, max_depth - 1, max_length))
+            return trimmed
+        self.remaining -= 8
+        return value
+
+    def trim_frames(self, frames):
+        """Keep the outermost and innermost MAX_FRAMES / 2 frames, and trim
+        them innermost first, since those matter most."""
+        if len(frames) > MAX_FRAMES:
+            self.trimmed_frames += len(frames) - MAX_FRAMES
+            frames = frames[:MAX_FRAMES // 2] + \
+                frames[len(frames) - MAX_FRAMES // 2:]
+        # Frame dicts contain vars, which contain the locals.
+        trimmed = [self.trim(frame, MAX_LOCALS_DEPTH + 2)
+                   for frame in reversed(frames)]
+        trimmed.reverse()
+        return trimmed
+
+    def report(self):
+        return {'chars': self.trimmed_chars, 'items': self.trimmed_items,
+                'frames': self.trimmed_frames}
+
+
+class TruncatingProcessor(object):
+    """Bounds the size of events: truncates strings (exception values to
+    MAX_EXCEPTION_LENGTH, everything else to MAX_STRING_LENGTH), stack
+    traces to MAX_FRAMES frames, locals and extra data to MAX_LOCALS_DEPTH
+    levels of nesting, breadcrumbs to the last MAX_BREADCRUMBS, and the
+    whole event to about MAX_PAYLOAD_SIZE characters, in a single pass.
+
+    Every other top-level key is trimmed too. Plain values (e.g. event_id,
+    level or culprit) come first, so they always survive, then exceptions,
+    then structured data such as request, user and contexts, so that what
+    gets cut when the event is over budget are tags, extra data and
+    breadcrumbs. If anything was cut, its size is reported in the `trimmed`
+    extra."""
+
+    # Implements the interface of raven.processors.Processor without
+    # subclassing it, so that raven doesn't need to be imported up front.
+    def __init__(self, client):
+        self.client = client
 
-    # Note(emfree): raven.processors.Processor provides a filter_stacktrace
-    # method to implement, but won't actually call it correctly. We can
-    # simplify this if it gets fixed upstream.
     def process(self, data, **kwargs):
-        if 'exception' not in data:
-            return data
-        if 'values' not in data['exception']:
-            return data
-        for item in data['exception']['values']:
-            item['value'] = item['value'][:MAX_EXCEPTION_LENGTH]
+        trimmer = _Trimmer(MAX_PAYLOAD_SIZE)
+        structured = []
+        for key, value in data.iteritems():
+            if key in _SPECIAL_KEYS:
+                continue
+            if isinstance(value, dict):
+                structured.append(key)
+            else:
+                data[key] = trimmer.trim(value, 1)
+        exception = data.get('exception')
+        if exception is not None:
+            for item in exception.get('values', ()):
+                if item.get('value') is not None:
+                    item['value'] = trimmer.trim(item['value'], 0,
+                                                 MAX_EXCEPTION_LENGTH)
+                stacktrace = item.get('stacktrace')
+                if stacktrace and stacktrace.get('frames'):
+                    stacktrace['frames'] = trimmer.trim_frames(
+                        stacktrace['frames'])
+        if 'message' in data:
+            data['message'] = trimmer.trim(data['message'], 0)
+        for key in structured:
+            data[key] = trimmer.trim(data[key], MAX_LOCALS_DEPTH)
+        if 'tags' in data:
+            data['tags'] = trimmer.trim(data['tags'], 1)
+        if 'extra' in data:
+            data['extra'] = trimmer.trim(data['extra'], MAX_LOCALS_DEPTH)
+        breadcrumbs = data.get('breadcrumbs')
+        if breadcrumbs is None and \
+                getattr(self.client, 'enable_breadcrumbs', False):
+            # raven only adds the breadcrumbs it recorded after running
+            # processors, and keeps any the event already has: add them
+            # here, so that they're trimmed too.
+            values = self.client.context.breadcrumbs.get_buffer()
+            if values:
+                breadcrumbs = data['breadcrumbs'] = {'values': values}
+        if breadcrumbs and breadcrumbs.get('values'):
+            values = breadcrumbs['values']
+            if len(values) > MAX_BREADCRUMBS:
+                trimmer.trimmed_items += len(values) - MAX_BREADCRUMBS
+                values = values[-MAX_BREADCRUMBS:]
+            breadcrumbs['values'] = trimmer.trim(values,
+                                                 MAX_LOCALS_DEPTH + 1)
+        if trimmer.trimmed_chars or trimmer.trimmed_items or \
+                trimmer.trimmed_frames:
+            extra = data.get('extra')
+            if not isinstance(extra, dict):
+                extra = data['extra'] = {}
+            extra['trimmed'] = trimmer.report()
         return data
 
 
+def enable_async_delivery(**kwargs):
+    """Make `sentry_alert` queue exceptions and capture them in the
+    background from now on. Keyword arguments are passed to
+    AsyncSentryDelivery; returns the AsyncSentryDelivery instance.
+
+    Queued exceptions are flushed at exit; see also
+    `flush_sentry_delivery`."""
+    global _async_delivery
+    from nylas.logging.sentry.delivery import AsyncSentryDelivery
+    if _async_delivery is None:
+        atexit.register(flush_sentry_delivery)
+    _async_delivery = AsyncSentryDelivery(get_sentry_client, **kwargs)
+    return _async_delivery
+
+
+def flush_sentry_delivery():
+    """Synchronously send the exceptions queued for background delivery, if
+    it is enabled."""
+    if _async_delivery is not None:
+        _async_delivery.flush()
+
+
+def enable_sampling(**kwargs):
+    """Make `sentry_alert` send only the first few exceptions with a given
+    fingerprint per time window from now on, followed by a summary message
+    with the number of suppressed ones. Keyword arguments are passed to
+    FingerprintSampler; returns the FingerprintSampler instance.
+
+    Summaries are sent while handling later exceptions, and from a
+    background greenlet which checks for them every window, so they go out
+    even if no further exception comes in."""
+    global _sampler
+    import gevent
+    _sampler = FingerprintSampler(**kwargs)
+    gevent.spawn(_send_summaries_periodically, _sampler)
+    return _sampler
+
+
+def _send_summaries_periodically(sampler):
+    import gevent
+    # Stops once sampling is disabled or reconfigured.
+    while _sampler is sampler:
+        gevent.sleep(sampler.window)
+        if _sampler is sampler and sentry_exceptions_enabled():
+            _send_suppressed_summaries()
+
+
+def _send_suppressed_summaries():
+    for exc_type, digest, count in _sampler.pop_summaries():
+        extra = {'error_name': getattr(exc_type, '__name__', None),
+                 'fingerprint': digest,
+                 'suppressed_count': count}
+        if _async_delivery is not None:
+            _async_delivery.submit_message(SUPPRESSED_EXCEPTIONS_SUMMARY,
+                                           extra=extra)
+            continue
+        try:
+            get_sentry_client().captureMessage(SUPPRESSED_EXCEPTIONS_SUMMARY,
+                                               extra=extra)
+        except URLError:
+            logger = get_logger()
+            logger.error('Error occured when sending exception to Sentry')
+
+
 def sentry_alert(*args, **kwargs):
     if sentry_exceptions_enabled():
+        if _sampler is not None or _async_delivery is not None:
+            exc_info = args[0] if args else kwargs.pop('exc_info', None)
+            args = ()
+            exc_info = exc_info or sys.exc_info()
+            if exc_info[0] is None:
+                return
+            if _sampler is not None:
+                allowed = _sampler.allow(exc_info[0], exc_info[2])
+                _send_suppressed_summaries()
+                if not allowed:
+                    return
+            if _async_delivery is not None:
+                _async_delivery.submit(exc_info, **kwargs)
+                return
+            kwargs['exc_info'] = exc_info
         try:
             get_sentry_client().captureException(*args, **kwargs)
         except URLError:
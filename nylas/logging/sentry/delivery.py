@@ -0,0 +1,173 @@
+"""
+Background delivery of exceptions to Sentry, so that requests that fail
+don't also pay for building and sending Sentry events.
+
+"""
+import os
+import time
+import collections
+
+import gevent
+import gevent.event
+
+from nylas.logging.fingerprint import traceback_fingerprint
+
+
+MAX_QUEUE_SIZE = 100
+MAX_BATCH_SIZE = 10
+FAILURE_THRESHOLD = 5
+FAILURE_COOLDOWN = 60
+
+# Reasons for dropping events.
+QUEUE_FULL = 'queue_full'
+CIRCUIT_OPEN = 'circuit_open'
+
+
+class AsyncSentryDelivery(object):
+    """Queue exceptions, and messages such as sampling summaries, and
+    capture them to Sentry from a background greenlet.
+
+    Exceptions with the same fingerprint (type and traceback locations)
+    that are queued at the same time are coalesced into a single event, with
+    an extra `coalesced_count` (the tags and extra data of the first one
+    are kept). Exceptions that don't fit in the queue are dropped and
+    counted. Queued events are sent in batches of MAX_BATCH_SIZE, yielding
+    to other greenlets in between.
+
+    After `failure_threshold` consecutive transport failures, the circuit
+    opens: for `failure_cooldown` seconds, events are dropped without being
+    built or sent. The next event after that is sent as a trial.
+
+    Queued exc_info tuples keep their traceback, and so every frame and
+    local variable along it, alive until they are sent. Events are built
+    from the background greenlet, outside of the request that raised: data
+    set on the raven client's context during the request isn't included,
+    so pass it as keyword arguments instead. Call `flush` before exiting to
+    send what is still queued.
+
+    Parameters
+    ----------
+    get_client: callable
+        Returns the raven client to capture exceptions with.
+    max_queue_size: int
+    failure_threshold: int
+    failure_cooldown: float
+    clock: callable, optional
+        Returns the current time in seconds.
+    """
+    def __init__(self, get_client, max_queue_size=MAX_QUEUE_SIZE,
+                 failure_threshold=FAILURE_THRESHOLD,
+                 failure_cooldown=FAILURE_COOLDOWN, clock=time.time):
+        self.get_client = get_client
+        self.max_queue_size = max_queue_size
+        self.failure_threshold = failure_threshold
+        self.failure_cooldown = failure_cooldown
+        self.clock = clock
+        self.sent = 0
+        self.coalesced = 0
+        self.failures = 0
+        self.dropped = collections.Counter()
+        self._consecutive_failures = 0
+        self._open_until = None
+        self._reset()
+
+    def _reset(self):
+        # Pending events of a parent process belong to the parent.
+        self._pid = os.getpid()
+        # fingerprint -> [capture method name, exc_info or message, kwargs,
+        # count]
+        self._queue = collections.OrderedDict()
+        self._wakeup = gevent.event.Event()
+        self._worker = None
+
+    def stats(self):
+        return {'queued': len(self._queue),
+                'sent': self.sent,
+                'coalesced': self.coalesced,
+                'failures': self.failures,
+                'dropped': dict(self.dropped),
+                'circuit_open': self.circuit_open}
+
+    @property
+    def circuit_open(self):
+        return self._open_until is not None and \
+            self.clock() < self._open_until
+
+    def submit(self, exc_info, **kwargs):
+        """Queue an exception for capture, with the keyword arguments of
+        `raven.Client.captureException`. Returns False if it was dropped."""
+        return self._enqueue(traceback_fingerprint(exc_info[0], exc_info[2]),
+                             'captureException', exc_info, kwargs)
+
+    def submit_message(self, message, **kwargs):
+        """Queue a message for capture, with the keyword arguments of
+        `raven.Client.captureMessage`. Messages aren't coalesced. Returns
+        False if it was dropped."""
+        return self._enqueue(object(), 'captureMessage', message, kwargs)
+
+    def _enqueue(self, key, method, value, kwargs):
+        if os.getpid() != self._pid:
+            self._reset()
+        if self.circuit_open:
+            self.dropped[CIRCUIT_OPEN] += 1
+            return False
+        entry = self._queue.get(key)
+        if entry is not None:
+            entry[3] += 1
+            self.coalesced += 1
+            return True
+        if len(self._queue) >= self.max_queue_size:
+            self.dropped[QUEUE_FULL] += 1
+            return False
+        self._queue[key] = [method, value, kwargs, 1]
+        if self._worker is None or self._worker.dead:
+            self._worker = gevent.spawn(self._run)
+        self._wakeup.set()
+        return True
+
+    def flush(self):
+        """Synchronously send everything that is queued."""
+        if os.getpid() != self._pid:
+            self._reset()
+        while self._queue:
+            self._send_batch()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait()
+            self._wakeup.clear()
+            while self._queue:
+                self._send_batch()
+                gevent.sleep(0)
+
+    def _send_batch(self):
+        for _ in range(min(MAX_BATCH_SIZE, len(self._queue))):
+            _, (method, value, kwargs, count) = \
+                self._queue.popitem(last=False)
+            self._send(method, value, kwargs, count)
+
+    def _send(self, method, value, kwargs, count):
+        if self.circuit_open:
+            self.dropped[CIRCUIT_OPEN] += count
+            return
+        if count > 1:
+            extra = dict(kwargs.get('extra') or {})
+            extra['coalesced_count'] = count
+            kwargs = dict(kwargs, extra=extra)
+        client = self.get_client()
+        try:
+            getattr(client, method)(value, **kwargs)
+            # raven reports failures of its own transports through the
+            # client state rather than by raising.
+            failed = client.state.did_fail()
+        except Exception:
+            failed = True
+        if not failed:
+            self.sent += 1
+            self._consecutive_failures = 0
+            self._open_until = None
+            return
+        self.failures += 1
+        self._consecutive_failures += 1
+        if self._consecutive_failures >= self.failure_threshold:
+            self._open_until = self.clock() + self.failure_cooldown
@@ -0,0 +1,84 @@
+"""
+Client-side sampling of Sentry events, so that one broken code path hit over
+and over doesn't send an event every time.
+
+"""
+import time
+import collections
+
+from nylas.logging.fingerprint import traceback_fingerprint, fingerprint_digest
+from nylas.logging.suppression import SuppressionWindows
+
+
+MAX_PER_WINDOW = 10
+WINDOW = 60
+MAX_FINGERPRINTS = 1000
+
+
+class _FingerprintState(object):
+    __slots__ = ('window_start', 'count', 'suppressed')
+
+    def __init__(self, now):
+        self.window_start = now
+        self.count = 0
+        self.suppressed = 0
+
+
+class FingerprintSampler(object):
+    """Let through the first `max_per_window` exceptions of each fingerprint
+    (type and traceback locations) per window of `window` seconds, and count
+    the rest.
+
+    Counts of suppressed exceptions are handed out by `pop_summaries` once
+    their window has ended. Fingerprints are kept in an LRU of at most
+    `max_fingerprints` entries; pending counts of evicted fingerprints are
+    summarized right away.
+
+    Parameters
+    ----------
+    max_per_window: int
+    window: float
+    max_fingerprints: int
+    clock: callable, optional
+        Returns the current time in seconds.
+    """
+    def __init__(self, max_per_window=MAX_PER_WINDOW, window=WINDOW,
+                 max_fingerprints=MAX_FINGERPRINTS, clock=time.time):
+        self.max_per_window = max_per_window
+        self.window = window
+        self.max_fingerprints = max_fingerprints
+        self.clock = clock
+        self.total_suppressed = 0
+        self._states = collections.OrderedDict()
+        self._windows = SuppressionWindows(window)
+
+    def allow(self, exc_type, tb):
+        """Return whether an exception should be sent, and record it as
+        suppressed if not."""
+        key = traceback_fingerprint(exc_type, tb)
+        now = self.clock()
+        state = self._states.pop(key, None)
+        if state is None or now - state.window_start >= self.window:
+            if state is not None:
+                # Summarize the previous window now, since its state is
+                # about to be replaced.
+                self._windows.evict(key)
+            state = _FingerprintState(now)
+        self._states[key] = state
+        if len(self._states) > self.max_fingerprints:
+            self._windows.evict(self._states.popitem(last=False)[0])
+
+        state.count += 1
+        if state.count <= self.max_per_window:
+            return True
+        self._windows.suppress(key, state)
+        self.total_suppressed += 1
+        return False
+
+    def pop_summaries(self):
+        """Return a list of (exception type, fingerprint digest, suppressed
+        count) for fingerprints whose window has ended. See
+        SuppressionWindows.pop_summaries."""
+        return [(key[0], fingerprint_digest(key), suppressed)
+                for key, suppressed in
+                self._windows.pop_summaries(self.clock())]
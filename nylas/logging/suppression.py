@@ -0,0 +1,60 @@
+"""
+Bookkeeping of suppressed events, shared by log rate limiting and Sentry
+sampling: counts are kept per key, and handed out as summaries once their
+window is over.
+
+"""
+
+
+class SuppressionWindows(object):
+    """Pending counts of suppressed events, per key.
+
+    Counts are kept on state objects owned by the caller, with a
+    `window_start` time and a `suppressed` count, so that looking them up
+    costs nothing extra. A key's count is summarized once `window` seconds
+    have passed since its `window_start`, or right away if the caller
+    evicts it.
+
+    Parameters
+    ----------
+    window: float
+    """
+    def __init__(self, window):
+        self.window = window
+        # key -> state, for keys with suppressed events.
+        self._pending = {}
+        self._evicted = []
+        self._next_sweep = 0
+
+    def suppress(self, key, state):
+        """Count a suppressed event of `key`."""
+        if not state.suppressed:
+            self._pending[key] = state
+        state.suppressed += 1
+
+    def evict(self, key):
+        """Summarize the pending count of `key` at the next `pop_summaries`,
+        whether or not its window is over, since its state is going away."""
+        state = self._pending.pop(key, None)
+        if state is not None:
+            self._evicted.append((key, state.suppressed))
+
+    def due(self, now):
+        """Return whether `pop_summaries` may have anything to return."""
+        return now >= self._next_sweep or bool(self._evicted)
+
+    def pop_summaries(self, now):
+        """Return a list of (key, suppressed count) for keys whose window
+        has ended, and reset their counts. Cheap to call often: pending keys
+        are checked at most once per second."""
+        if not self.due(now):
+            return []
+        summaries = self._evicted
+        self._evicted = []
+        self._next_sweep = now + min(1, self.window)
+        for key, state in self._pending.items():
+            if now - state.window_start >= self.window:
+                summaries.append((key, state.suppressed))
+                state.suppressed = 0
+                del self._pending[key]
+        return summaries
@@ -0,0 +1,58 @@
+"""
+Cheap timestamps for log events.
+
+"""
+import time
+import datetime
+
+
+ISO = 'iso'
+EPOCH = 'epoch'
+EPOCH_MS = 'epoch_ms'
+TIMESTAMP_FORMATS = (ISO, EPOCH, EPOCH_MS)
+
+
+class ISOTimestamper(object):
+    """Callable returning the current UTC time as an ISO 8601 string, exactly
+    as `datetime.datetime.utcnow().isoformat() + 'Z'` would. The formatted
+    date and time up to the second is cached, so events logged within the
+    same second only pay for formatting the microseconds.
+
+    Parameters
+    ----------
+    clock: callable, optional
+        Returns the current time in seconds since the epoch.
+    """
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        # (second, formatted prefix), replaced as a whole so that it's
+        # consistent even if other threads log too.
+        self._cached = (None, None)
+
+    def __call__(self):
+        now = self.clock()
+        second = int(now)
+        micro = int(round((now - second) * 1e6))
+        if micro >= 1000000:
+            second += 1
+            micro -= 1000000
+        cached_second, prefix = self._cached
+        if second != cached_second:
+            prefix = datetime.datetime.utcfromtimestamp(second).isoformat()
+            self._cached = (second, prefix)
+        if micro:
+            return '%s.%06dZ' % (prefix, micro)
+        return prefix + 'Z'
+
+
+def make_timestamper(fmt=ISO, clock=time.time):
+    """Return a callable that returns the current time in the given format:
+    an ISO 8601 string ('iso'), float seconds since the epoch ('epoch') or
+    integer milliseconds since the epoch ('epoch_ms')."""
+    if fmt == ISO:
+        return ISOTimestamper(clock)
+    elif fmt == EPOCH:
+        return clock
+    elif fmt == EPOCH_MS:
+        return lambda: int(clock() * 1000)
+    raise ValueError('Unknown timestamp format {!r}'.format(fmt))
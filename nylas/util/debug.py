@@ -1,5 +1,7 @@
 import sys
 import time
+import hashlib
+import itertools
 import traceback
 import collections
 
@@ -7,38 +9,140 @@ import gevent._threading
 import greenlet
 
 from nylas.logging import get_logger
+from nylas.util.histogram import Histogram
+from nylas.util.threads import thread_ident_function
 
 MAX_BLOCKING_TIME = 5
+MAX_PROFILE_STACKS = 1000
+# Switches recorded in light mode between two runs of the monitoring thread;
+# older ones are discarded beyond that.
+MAX_PENDING_SWITCHES = 100000
+LIGHT_AGGREGATE_INTERVAL = 0.05
+BLOCKING_REPEAT_WINDOW = 300
+MAX_BLOCKING_FINGERPRINTS = 1000
+LOOP_LAG_INTERVAL = 0.1
+LOOP_LAG_LOG_INTERVAL = 60
+# recent_lag is the highest lag measured over that many seconds.
+LOOP_LAG_RECENT_WINDOW = 1
+
+# CPU time of the calling thread where available (Python 3.7+), otherwise
+# CPU time of the whole process.
+_cpu_clock = getattr(time, 'thread_time', None) or time.clock
+# Python 2 has no monotonic clock in the standard library.
+_monotonic = getattr(time, 'monotonic', time.time)
+
+
+def _stack_codes(frame):
+    """Return the code objects of a stack, outermost first."""
+    stack = []
+    while frame is not None:
+        stack.append(frame.f_code)
+        frame = frame.f_back
+    stack.reverse()
+    return tuple(stack)
+
+
+def _format_code(code):
+    return '{}:{}:{}'.format(code.co_filename, code.co_name,
+                             code.co_firstlineno)
+
+
+def set_greenlet_context(context, glet=None):
+    """Tag a greenlet (by default the current one) with the context its
+    time is accounted to by `Tracer`."""
+    if glet is None:
+        glet = greenlet.getcurrent()
+    glet.context = context
 
 
 class Tracer(object):
     """Log if a greenlet blocks the event loop for too long, and optionally log
-    statistics on time spent in individual greenlets.
+    statistics on time spent in individual greenlets, or a sampling profile
+    of the main thread.
+
+    Time spent is accounted to the `context` attribute of greenlets, which
+    can be set with `set_greenlet_context`; greenlets without one are all
+    accounted to None.
 
     Parameters
     ----------
     gather_stats: bool
-        Whether to periodically log statistics about time spent.
+        Whether to periodically log statistics about time spent, including
+        a histogram of run slices (time between switches) per context.
+    cpu_time: bool
+        If set, measure run slices in CPU time rather than wall clock time,
+        so that time the process spends descheduled isn't accounted to
+        greenlets. On Python 2 this is CPU time of the whole process,
+        including other threads.
+    light: bool
+        If set, the switch hook only records a timestamp and the target
+        greenlet of each switch, and leaves detecting blocking and gathering
+        stats to the monitoring thread, which processes recorded switches
+        every LIGHT_AGGREGATE_INTERVAL seconds. This makes switches much
+        cheaper, especially with gather_stats. If more than
+        MAX_PENDING_SWITCHES switches pile up in between, the oldest are
+        dropped, counted in `dropped_switches` and left out of the stats.
     max_blocking_time: float
         Log a warning if a greenlet blocks for more than max_blocking_time
         seconds.
+    blocking_repeat_window: float
+        Blocking stacks are fingerprinted by their code objects. The full
+        stack is logged the first time a fingerprint is seen within
+        blocking_repeat_window seconds; after that, a compact 'greenlet still
+        blocking' event with a repeat count is logged instead.
+    sample_interval: float, optional
+        If set, sample the main thread's stack every sample_interval seconds
+        and aggregate the samples into a profile (see `dump_profile`).
+    max_profile_stacks: int
+        Maximum number of distinct stacks kept in the profile. Samples of
+        further stacks are only counted in `profile_dropped_samples`.
+    log_profile_interval: float, optional
+        If set (along with sample_interval), log the profile and start a new
+        one every log_profile_interval seconds.
     """
     def __init__(self, gather_stats=False,
-                 max_blocking_time=MAX_BLOCKING_TIME):
+                 max_blocking_time=MAX_BLOCKING_TIME, sample_interval=None,
+                 max_profile_stacks=MAX_PROFILE_STACKS,
+                 log_profile_interval=None, cpu_time=False, light=False,
+                 blocking_repeat_window=BLOCKING_REPEAT_WINDOW):
         self.gather_stats = gather_stats
+        self.blocking_repeat_window = blocking_repeat_window
+        self.cpu_time = cpu_time
+        self.light = light
+        self._clock = _cpu_clock if cpu_time else _monotonic
         self.max_blocking_time = max_blocking_time
+        self.sample_interval = sample_interval
+        self.max_profile_stacks = max_profile_stacks
+        self.log_profile_interval = log_profile_interval
         self.time_spent_by_context = collections.defaultdict(float)
+        self.run_slices_by_context = collections.defaultdict(Histogram)
         self.total_switches = 0
         self._last_switch_time = None
         self._switch_flag = False
         self._active_greenlet = None
-        self._main_thread_id = gevent._threading.get_ident()
+        self._blocking_since = None
+        # Maps blocking stacks (tuples of code objects) to _BlockingState,
+        # least recently seen first.
+        self._blocking_fingerprints = collections.OrderedDict()
+        self._main_thread_id = thread_ident_function()()
         self._hub = gevent.hub.get_hub()
+        # (sequence number, timestamp, target) of switches not yet
+        # processed, in light mode.
+        self._switches = collections.deque(maxlen=MAX_PENDING_SWITCHES)
+        self._next_switch_number = 0
+        self.dropped_switches = 0
+        # Maps tuples of code objects, outermost first, to sample counts.
+        self._profile = collections.defaultdict(int)
+        self.profile_samples = 0
+        self.profile_dropped_samples = 0
         self.log = get_logger()
 
     def start(self):
         self.start_time = time.time()
-        greenlet.settrace(self._trace)
+        if self.light:
+            greenlet.settrace(self._make_light_trace())
+        else:
+            greenlet.settrace(self._trace)
         # Spawn a separate OS thread to periodically check if the active
         # greenlet on the main thread is blocking.
         gevent._threading.start_new_thread(self._monitoring_thread, ())
@@ -49,14 +153,19 @@ class Tracer(object):
                                    key=lambda (k, v): v, reverse=True)
         formatted_times = {k: round(v, 2) for k, v in
                            greenlets_by_cost[:max_stats]}
+        run_slices = {k: self.run_slices_by_context[k].summary() for k, _ in
+                      greenlets_by_cost[:max_stats]}
         self.log.info('greenlet stats',
                       times=formatted_times,
+                      run_slices=run_slices,
+                      cpu_time=self.cpu_time,
                       total_switches=self.total_switches,
+                      dropped_switches=self.dropped_switches,
                       total_time=total_time)
 
     def _trace(self, event, (origin, target)):
         self.total_switches += 1
-        current_time = time.time()
+        current_time = self._clock()
         if self.gather_stats and self._last_switch_time is not None:
             time_spent = current_time - self._last_switch_time
             if origin is not self._hub:
@@ -64,34 +173,310 @@ class Tracer(object):
             else:
                 context = 'hub'
             self.time_spent_by_context[context] += time_spent
+            self.run_slices_by_context[context].add(time_spent)
         self._active_greenlet = target
         self._last_switch_time = current_time
         self._switch_flag = True
 
+    def _make_light_trace(self):
+        # A closure, to save attribute lookups on every switch.
+        clock = self._clock
+        record = self._switches.append
+        # Numbering switches lets the monitoring thread tell when the
+        # oldest ones were dropped from the deque.
+        next_number = itertools.count(self._next_switch_number).next
+
+        def trace(event, args):
+            record((next_number(), clock(), args[1]))
+        return trace
+
+    def _process_switches(self):
+        """Account for the switches recorded by the light trace function
+        since the last call."""
+        switches = self._switches
+        last_time = self._last_switch_time
+        active_greenlet = self._active_greenlet
+        expected_number = self._next_switch_number
+        count = 0
+        # Only the monitoring thread consumes the deque, so it can't become
+        # empty between the check and popleft().
+        while switches:
+            number, switch_time, target = switches.popleft()
+            if number != expected_number:
+                # The deque overflowed: which greenlets ran in the gap is
+                # unknown, so don't account the time across it to anyone.
+                self.dropped_switches += number - expected_number
+                count += number - expected_number
+                last_time = None
+            expected_number = number + 1
+            if self.gather_stats and last_time is not None:
+                if active_greenlet is not self._hub:
+                    context = getattr(active_greenlet, 'context', None)
+                else:
+                    context = 'hub'
+                time_spent = switch_time - last_time
+                self.time_spent_by_context[context] += time_spent
+                self.run_slices_by_context[context].add(time_spent)
+            last_time = switch_time
+            active_greenlet = target
+            count += 1
+        self._next_switch_number = expected_number
+        if count:
+            self.total_switches += count
+            self._last_switch_time = last_time
+            self._active_greenlet = active_greenlet
+            self._switch_flag = True
+
     def _check_blocking(self):
         if self._switch_flag is False:
             active_greenlet = self._active_greenlet
             if active_greenlet is not None and active_greenlet != self._hub:
+                now = time.time()
+                if self._blocking_since is None:
+                    self._blocking_since = now - self.max_blocking_time
                 # greenlet.gr_frame doesn't work on another thread -- we have
                 # to get the main thread's frame.
                 frame = sys._current_frames()[self._main_thread_id]
-                formatted_frame = '\t'.join(traceback.format_stack(frame))
-                self.log.warning(
-                    'greenlet blocking', frame=formatted_frame,
-                    context=getattr(active_greenlet, 'context', None),
-                    blocking_greenlet_id=id(active_greenlet))
+                self._log_blocking(frame, active_greenlet, now)
+        else:
+            self._blocking_since = None
         self._switch_flag = False
 
+    def _log_blocking(self, frame, active_greenlet, now):
+        stack = _stack_codes(frame)
+        state = self._blocking_fingerprints.pop(stack, None)
+        if state is None or \
+                now - state.window_start >= self.blocking_repeat_window:
+            digest = hashlib.md5(';'.join(_format_code(code) for code in
+                                          stack)).hexdigest()[:16]
+            state = _BlockingState(digest, now)
+        else:
+            state.repeat_count += 1
+        self._blocking_fingerprints[stack] = state
+        if len(self._blocking_fingerprints) > MAX_BLOCKING_FINGERPRINTS:
+            self._blocking_fingerprints.popitem(last=False)
+
+        context = getattr(active_greenlet, 'context', None)
+        blocking_time = round(now - self._blocking_since, 3)
+        if state.repeat_count == 0:
+            formatted_frame = '\t'.join(traceback.format_stack(frame))
+            self.log.warning(
+                'greenlet blocking', frame=formatted_frame, context=context,
+                blocking_greenlet_id=id(active_greenlet),
+                blocking_time=blocking_time, fingerprint=state.digest)
+        else:
+            self.log.warning(
+                'greenlet still blocking', context=context,
+                blocking_greenlet_id=id(active_greenlet),
+                blocking_time=blocking_time, fingerprint=state.digest,
+                repeat_count=state.repeat_count)
+
+    def _sample(self):
+        stack = _stack_codes(sys._current_frames().get(self._main_thread_id))
+        self.profile_samples += 1
+        if stack in self._profile or \
+                len(self._profile) < self.max_profile_stacks:
+            self._profile[stack] += 1
+        else:
+            self.profile_dropped_samples += 1
+
+    def dump_profile(self):
+        """Return the profile in the collapsed stack format used by
+        flamegraph.pl and compatible tools: one line per stack, with frames
+        separated by semicolons (outermost first), followed by a space and
+        the number of samples."""
+        lines = []
+        for stack, count in self._profile.items():
+            frames = ';'.join(_format_code(code) for code in stack)
+            lines.append('{} {}'.format(frames, count))
+        lines.sort()
+        return '\n'.join(lines)
+
+    def reset_profile(self):
+        self._profile = collections.defaultdict(int)
+        self.profile_samples = 0
+        self.profile_dropped_samples = 0
+
+    def log_profile(self):
+        self.log.info('greenlet profile',
+                      profile=self.dump_profile(),
+                      samples=self.profile_samples,
+                      dropped_samples=self.profile_dropped_samples,
+                      sample_interval=self.sample_interval)
+
     def _monitoring_thread(self):
-        last_logged_stats = time.time()
+        last_logged_stats = last_logged_profile = time.time()
+        sleep_time = self.max_blocking_time
+        if self.sample_interval:
+            sleep_time = min(sleep_time, self.sample_interval)
+        if self.light:
+            sleep_time = min(sleep_time, LIGHT_AGGREGATE_INTERVAL)
+        # Blocking is checked every max_blocking_time seconds, even when
+        # waking up more often to take samples.
+        iterations_per_check = max(1, int(round(self.max_blocking_time /
+                                                sleep_time)))
+        iteration = 0
         try:
             while True:
-                self._check_blocking()
-                if self.gather_stats and time.time() - last_logged_stats > 60:
+                now = time.time()
+                if self.light:
+                    self._process_switches()
+                if iteration % iterations_per_check == 0:
+                    self._check_blocking()
+                iteration += 1
+                if self.sample_interval:
+                    self._sample()
+                    if self.log_profile_interval and \
+                            now - last_logged_profile > \
+                            self.log_profile_interval:
+                        self.log_profile()
+                        self.reset_profile()
+                        last_logged_profile = now
+                if self.gather_stats and now - last_logged_stats > 60:
                     self.log_stats()
-                    last_logged_stats = time.time()
-                gevent.sleep(self.max_blocking_time)
+                    last_logged_stats = now
+                gevent.sleep(sleep_time)
         # Swallow exceptions raised during interpreter shutdown.
         except Exception:
             if sys is not None:
                 raise
+
+
+class _BlockingState(object):
+    __slots__ = ('digest', 'window_start', 'repeat_count')
+
+    def __init__(self, digest, window_start):
+        self.digest = digest
+        self.window_start = window_start
+        self.repeat_count = 0
+
+
+class LoopLagMonitor(object):
+    """Measure event loop lag, i.e. how much later than scheduled a periodic
+    timer on the gevent hub gets to run, along with the number of runnable
+    greenlets (callbacks scheduled with `loop.run_callback`, which is how
+    greenlets are spawned and woken up) and of pending watcher callbacks.
+
+    Unlike `Tracer`, this catches short blocks too, and is cheap enough to
+    leave on: it costs one timer callback per interval.
+
+    Lag is aggregated in a histogram per window of log_interval seconds;
+    `stats` covers the current and the previous window. `recent_lag` is the
+    highest lag over the last recent_window seconds, which unlike `last_lag`
+    isn't reset by the next on-time tick.
+
+    Parameters
+    ----------
+    interval: float
+        How often to measure, in seconds.
+    log_interval: float, optional
+        If set, log stats for each window of log_interval seconds.
+    recent_window: float, optional
+    """
+    def __init__(self, interval=LOOP_LAG_INTERVAL,
+                 log_interval=LOOP_LAG_LOG_INTERVAL,
+                 recent_window=LOOP_LAG_RECENT_WINDOW):
+        self.interval = interval
+        self.log_interval = log_interval
+        self.last_lag = 0.
+        self._recent_lags = collections.deque(
+            maxlen=max(1, int(round(recent_window / float(interval)))))
+        self.runnable_greenlets = 0
+        self.pending_callbacks = 0
+        self._window = _LagWindow()
+        self._previous_window = _LagWindow()
+        self._loop = None
+        self._timer = None
+        self._last_tick = None
+        self.log = get_logger()
+
+    def start(self):
+        self._loop = gevent.get_hub().loop
+        self._timer = self._loop.timer(self.interval, self.interval)
+        # Don't keep the event loop alive just to measure it.
+        self._timer.ref = False
+        self._last_tick = self._window.start_time = _monotonic()
+        self._timer.start(self._tick)
+
+    def stop(self):
+        if self._timer is not None:
+            self._timer.stop()
+            self._timer = None
+
+    def _tick(self):
+        # A late tick is followed by an early one (libev keeps the timer on
+        # schedule), which counts as no lag.
+        now = _monotonic()
+        lag = max(0., now - self._last_tick - self.interval)
+        self._last_tick = now
+        loop = self._loop
+        self.record(lag,
+                    len(getattr(loop, '_callbacks', ())),
+                    getattr(loop, 'pendingcnt', 0))
+        if self.log_interval and \
+                now - self._window.start_time >= self.log_interval:
+            # Logging may need to switch greenlets, which the hub can't do.
+            gevent.spawn(self.log_window, self._rotate(now))
+
+    def log_window(self, window):
+        self.log.info('loop lag', interval=self.interval, **window.stats())
+
+    def record(self, lag, runnable_greenlets, pending_callbacks):
+        self.last_lag = lag
+        self._recent_lags.append(lag)
+        self.runnable_greenlets = runnable_greenlets
+        self.pending_callbacks = pending_callbacks
+        self._window.record(lag, runnable_greenlets, pending_callbacks)
+
+    @property
+    def recent_lag(self):
+        return max(self._recent_lags) if self._recent_lags else 0.
+
+    def _rotate(self, now):
+        """Start a new window, and return the one that just ended."""
+        window = self._window
+        self._previous_window = window
+        self._window = _LagWindow()
+        self._window.start_time = now
+        return window
+
+    def stats(self):
+        window = _LagWindow()
+        window.merge(self._previous_window)
+        window.merge(self._window)
+        stats = window.stats()
+        stats.update(last_lag=self.last_lag,
+                     recent_lag=self.recent_lag,
+                     runnable_greenlets=self.runnable_greenlets,
+                     pending_callbacks=self.pending_callbacks)
+        return stats
+
+
+class _LagWindow(object):
+    __slots__ = ('start_time', 'lag', 'max_runnable_greenlets',
+                 'max_pending_callbacks')
+
+    def __init__(self):
+        self.start_time = None
+        self.lag = Histogram()
+        self.max_runnable_greenlets = 0
+        self.max_pending_callbacks = 0
+
+    def record(self, lag, runnable_greenlets, pending_callbacks):
+        self.lag.add(lag)
+        self.max_runnable_greenlets = max(self.max_runnable_greenlets,
+                                          runnable_greenlets)
+        self.max_pending_callbacks = max(self.max_pending_callbacks,
+                                         pending_callbacks)
+
+    def merge(self, other):
+        self.lag.merge(other.lag)
+        self.max_runnable_greenlets = max(self.max_runnable_greenlets,
+                                          other.max_runnable_greenlets)
+        self.max_pending_callbacks = max(self.max_pending_callbacks,
+                                         other.max_pending_callbacks)
+
+    def stats(self):
+        return {'lag': self.lag.summary(),
+                'max_runnable_greenlets': self.max_runnable_greenlets,
+                'max_pending_callbacks': self.max_pending_callbacks}
@@ -0,0 +1,63 @@
+import bisect
+
+
+# Bucket upper bounds in seconds, doubling from 10us to ~10.5s.
+DEFAULT_BOUNDS = tuple(1e-5 * 2 ** i for i in range(21))
+
+
+class Histogram(object):
+    """Histogram with fixed buckets, so that adding a value is cheap and
+    memory use is constant.
+
+    Percentiles are estimated as the upper bound of the bucket they fall
+    in (or the maximum value seen, if that is lower).
+
+    Parameters
+    ----------
+    bounds: sequence of float
+        Sorted upper bounds of the buckets. Values above the last bound go
+        into an overflow bucket.
+    """
+    __slots__ = ('bounds', 'counts', 'count', 'total', 'max')
+
+    def __init__(self, bounds=DEFAULT_BOUNDS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0.
+        self.max = 0.
+
+    def add(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        """Add the values of a histogram with the same bounds."""
+        for i, count in enumerate(other.counts):
+            self.counts[i] += count
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def percentile(self, p):
+        if not self.count:
+            return None
+        # Rank of the value we're after, counting from 1.
+        rank = max(1, p / 100. * self.count)
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                if i < len(self.bounds):
+                    return min(self.bounds[i], self.max)
+                return self.max
+
+    def summary(self):
+        return {'count': self.count,
+                'total': self.total,
+                'p50': self.percentile(50),
+                'p99': self.percentile(99),
+                'max': self.max}
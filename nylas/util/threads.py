@@ -0,0 +1,45 @@
+"""
+Access to gevent's native OS threading primitives, which are never
+monkeypatched.
+
+gevent is imported on first use rather than with this module, since
+importing it is slow and many processes never need these.
+
+"""
+
+
+def native_threading():
+    """Return gevent's unpatched threading module."""
+    import gevent._threading
+    return gevent._threading
+
+
+def thread_ident_function():
+    """Return the function giving the identifier of the current OS
+    thread."""
+    threading = native_threading()
+    try:
+        return threading.get_ident
+    except AttributeError:
+        # Renamed in gevent 1.3.
+        return threading.get_thread_ident
+
+
+class LazyNativeLock(object):
+    """Native lock for use in a with statement, created on first use so that
+    objects built at import time don't import gevent."""
+    def __init__(self):
+        self._lock = None
+        self._created = {}
+
+    def __enter__(self):
+        lock = self._lock
+        if lock is None:
+            # setdefault is atomic, so threads racing to create the lock all
+            # end up with the same one.
+            lock = self._lock = self._created.setdefault(
+                None, native_threading().Lock())
+        lock.acquire()
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self._lock.release()
@@ -1,4 +1,5 @@
 import os
+import sys
 import logging
 import tempfile
 
@@ -31,3 +32,74 @@ def logfile(request):
     request.addfinalizer(remove_logs)
 
     return logfile
+
+
+class FakeClock(object):
+    """Clock for code that takes a `clock` callable; set or advance `now`
+    by hand."""
+    def __init__(self):
+        self.now = 0.
+
+    def __call__(self):
+        return self.now
+
+
+@fixture
+def clock():
+    return FakeClock()
+
+
+def _exc_info_from(line):
+    try:
+        if line == 1:
+            raise ValueError()
+        else:
+            raise ValueError()
+    except ValueError:
+        return sys.exc_info()
+
+
+@fixture
+def exc_info_from():
+    """
+    Returns a function giving the exc_info of a ValueError raised from one
+    of two lines (1 or 2), i.e. with one of two fingerprints.
+
+    """
+    return _exc_info_from
+
+
+class FakeState(object):
+    def __init__(self):
+        self.failed = False
+
+    def did_fail(self):
+        return self.failed
+
+
+class FakeClient(object):
+    """Records what would be captured, as (exception type or message,
+    keyword arguments) tuples."""
+    def __init__(self):
+        self.state = FakeState()
+        self.captured = []
+
+    def captureException(self, exc_info, **kwargs):
+        self.captured.append((exc_info[0], kwargs))
+
+    def captureMessage(self, message, **kwargs):
+        self.captured.append((message, kwargs))
+
+
+@fixture
+def sentry_client(monkeypatch):
+    """
+    Returns a fake raven client, installed as the client of
+    nylas.logging.sentry, with Sentry enabled.
+
+    """
+    from nylas.logging import sentry
+    client = FakeClient()
+    monkeypatch.setenv('SENTRY_DSN', 'http://key@localhost/1')
+    monkeypatch.setattr(sentry, '_sentry_client', client)
+    return client
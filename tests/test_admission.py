@@ -0,0 +1,28 @@
+from nylas.api.admission import AdmissionControl, IN_FLIGHT, LOOP_LAG
+from nylas.util.debug import LoopLagMonitor
+
+
+def test_in_flight_limit():
+    admission = AdmissionControl()
+    assert admission.admit(max_in_flight=2) is None
+    assert admission.admit(max_in_flight=2) is None
+    assert admission.admit(max_in_flight=2) == IN_FLIGHT
+    assert admission.in_flight == 2
+    admission.release()
+    assert admission.admit(max_in_flight=2) is None
+    assert admission.admit() is None
+    assert admission.shed == {IN_FLIGHT: 1}
+
+
+def test_loop_lag_limit():
+    monitor = LoopLagMonitor(interval=0.1, recent_window=0.2)
+    admission = AdmissionControl(loop_lag_monitor=monitor)
+    monitor.record(0.5, 100, 0)
+    assert admission.admit(max_loop_lag=0.2) == LOOP_LAG
+    # Still shed after the next on-time tick, until the lag is out of the
+    # recent window.
+    monitor.record(0.01, 1, 0)
+    assert admission.admit(max_loop_lag=0.2) == LOOP_LAG
+    monitor.record(0.01, 1, 0)
+    assert admission.admit(max_loop_lag=0.2) is None
+    assert admission.total_shed == 2
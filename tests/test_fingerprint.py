@@ -0,0 +1,87 @@
+import sys
+import threading
+
+from nylas.logging.fingerprint import TracebackCache, traceback_fingerprint
+
+
+def raise_value_error(msg):
+    raise ValueError(msg)
+
+
+def raise_key_error(msg):
+    raise KeyError(msg)
+
+
+def get_exc_info(fn, msg='boom'):
+    try:
+        fn(msg)
+    except Exception:
+        return sys.exc_info()
+
+
+def test_fingerprint_ignores_exception_value():
+    etype, _, tb = get_exc_info(raise_value_error, 'a')
+    etype2, _, tb2 = get_exc_info(raise_value_error, 'b')
+    assert traceback_fingerprint(etype, tb) == \
+        traceback_fingerprint(etype2, tb2)
+
+    etype3, _, tb3 = get_exc_info(raise_key_error)
+    assert traceback_fingerprint(etype, tb) != \
+        traceback_fingerprint(etype3, tb3)
+
+
+def test_cache_reuses_formatted_traceback():
+    cache = TracebackCache()
+    etype, _, tb = get_exc_info(raise_value_error)
+    first = cache.lookup(etype, tb)
+    etype, _, tb = get_exc_info(raise_value_error)
+    second = cache.lookup(etype, tb)
+    assert first is second
+    assert 'raise_value_error' in first.formatted_tb
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_cache_is_bounded():
+    cache = TracebackCache(max_entries=1)
+    cache.lookup(*get_exc_info(raise_value_error)[::2])
+    entry = cache.lookup(*get_exc_info(raise_key_error)[::2])
+    assert len(cache) == 1
+    assert cache.lookup(*get_exc_info(raise_key_error)[::2]) is entry
+
+    cache = TracebackCache(max_bytes=len(entry.formatted_tb) - 1)
+    cache.lookup(*get_exc_info(raise_key_error)[::2])
+    assert len(cache) == 0
+
+
+def test_count_repeat():
+    cache = TracebackCache()
+    assert cache.count_repeat('abc', now=0) == 0
+
+    cache = TracebackCache(repeat_window=10)
+    assert cache.count_repeat('abc', now=0) == 0
+    assert cache.count_repeat('abc', now=1) == 1
+    assert cache.count_repeat('def', now=1) == 0
+    assert cache.count_repeat('abc', now=9) == 2
+    assert cache.count_repeat('abc', now=10) == 0
+
+
+def test_cache_is_consistent_across_threads():
+    cache = TracebackCache(max_entries=1, repeat_window=10)
+    exc_infos = [get_exc_info(raise_value_error)[::2],
+                 get_exc_info(raise_key_error)[::2]]
+
+    def hammer():
+        for i in range(2000):
+            cache.lookup(*exc_infos[i % 2])
+            cache.count_repeat('abc', now=0)
+    threads = [threading.Thread(target=hammer) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(cache) == 1
+    assert cache._bytes == sum(len(entry.formatted_tb)
+                               for entry in cache._entries.values())
+    assert cache.hits + cache.misses == 8000
+    assert cache.count_repeat('abc', now=0) == 8000
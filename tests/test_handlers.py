@@ -0,0 +1,159 @@
+import time
+import logging
+import threading
+from StringIO import StringIO
+
+import gevent
+import gevent._threading
+from pytest import raises
+
+from nylas.logging.handlers import (AsyncStreamHandler, BufferedStreamHandler,
+                                    DROP_OLDEST, DROP_DEBUG_FIRST, BLOCK)
+
+
+class GatedStream(StringIO):
+    """StringIO whose writes block until the gate is opened."""
+    def __init__(self):
+        StringIO.__init__(self)
+        self.gate = gevent._threading.Lock()
+        self.gate.acquire()
+
+    def write(self, s):
+        with self.gate:
+            StringIO.write(self, s)
+
+
+def make_record(msg, level=logging.INFO):
+    return logging.LogRecord('test', level, __file__, 1, msg, (), None)
+
+
+def fill_while_blocked(handler, stream, records):
+    # The first record is picked up by the drain thread, which then blocks
+    # on the stream, so the remaining ones pile up in the queue.
+    handler.handle(make_record('first'))
+    deadline = time.time() + 5
+    while handler.stats()['queued'] and time.time() < deadline:
+        time.sleep(0.001)
+    for msg, level in records:
+        handler.handle(make_record(msg, level))
+
+
+def test_async_handler_writes_batches():
+    stream = StringIO()
+    handler = AsyncStreamHandler(stream)
+    for i in range(100):
+        handler.handle(make_record(str(i)))
+    handler.flush()
+    assert stream.getvalue().splitlines() == [str(i) for i in range(100)]
+    assert handler.stats()['written'] == 100
+    assert handler.stats()['dropped'] == 0
+    handler.close()
+
+
+def test_async_handler_drop_oldest():
+    stream = GatedStream()
+    handler = AsyncStreamHandler(stream, max_queue_size=3,
+                                 overflow_policy=DROP_OLDEST)
+    fill_while_blocked(handler, stream,
+                       [(str(i), logging.INFO) for i in range(5)])
+    stream.gate.release()
+    handler.close()
+    assert stream.getvalue().splitlines() == ['first', '2', '3', '4']
+    assert handler.stats()['dropped_by_level'] == {'INFO': 2}
+
+
+def test_async_handler_drop_debug_first():
+    stream = GatedStream()
+    handler = AsyncStreamHandler(stream, max_queue_size=3,
+                                 overflow_policy=DROP_DEBUG_FIRST)
+    fill_while_blocked(handler, stream,
+                       [('a', logging.INFO), ('b', logging.DEBUG),
+                        ('c', logging.INFO), ('d', logging.ERROR),
+                        ('e', logging.DEBUG), ('f', logging.WARNING)])
+    stream.gate.release()
+    handler.close()
+    assert stream.getvalue().splitlines() == ['first', 'c', 'd', 'f']
+    assert handler.stats()['dropped_by_level'] == {'DEBUG': 2, 'INFO': 1}
+
+
+class SlowLock(object):
+    """Lock that lets other threads run before it is acquired, to widen
+    races."""
+    def __init__(self, lock):
+        self.lock = lock
+
+    def __enter__(self):
+        time.sleep(0.001)
+        self.lock.acquire()
+
+    def __exit__(self, *exc_info):
+        self.lock.release()
+
+
+class SlowStream(GatedStream):
+    def write(self, s):
+        GatedStream.write(self, s)
+        time.sleep(0.002)
+
+
+def test_async_handler_block_never_drops():
+    stream = SlowStream()
+    handler = AsyncStreamHandler(stream, max_queue_size=2,
+                                 overflow_policy=BLOCK)
+    handler._mutex = SlowLock(handler._mutex)
+    fill_while_blocked(handler, stream, [])
+
+    # emit() rather than handle(), which would serialize the producers on
+    # the handler's own lock.
+    def produce(name):
+        for i in range(20):
+            handler.emit(make_record('{}{}'.format(name, i)))
+    producers = [threading.Thread(target=produce, args=(name,))
+                 for name in 'abcd']
+    for producer in producers:
+        producer.start()
+    # The producers fill the queue and then wait for room.
+    time.sleep(0.05)
+    assert handler.stats()['queued'] == 2
+    assert all(producer.is_alive() for producer in producers)
+
+    stream.gate.release()
+    for producer in producers:
+        producer.join(5)
+    handler.close()
+    lines = stream.getvalue().splitlines()
+    assert len(lines) == 81
+    assert sorted(lines[1:]) == sorted('{}{}'.format(name, i)
+                                       for name in 'abcd' for i in range(20))
+    assert handler.stats()['dropped'] == 0
+
+
+def test_async_handler_rejects_unknown_policy():
+    with raises(ValueError):
+        AsyncStreamHandler(StringIO(), overflow_policy='drop_everything')
+
+
+def test_buffered_handler_flushes_by_size_and_level():
+    stream = StringIO()
+    handler = BufferedStreamHandler(stream, max_buffer_bytes=8,
+                                    max_latency=60)
+    handler.handle(make_record('abc'))
+    assert stream.getvalue() == ''
+    handler.handle(make_record('defg'))
+    assert stream.getvalue() == 'abc\ndefg\n'
+
+    handler.handle(make_record('h'))
+    handler.handle(make_record('oh no', logging.ERROR))
+    assert stream.getvalue() == 'abc\ndefg\nh\noh no\n'
+    handler.close()
+
+
+def test_buffered_handler_flushes_after_latency():
+    stream = StringIO()
+    handler = BufferedStreamHandler(stream, max_latency=0.01)
+    handler.handle(make_record('abc'))
+    handler.handle(make_record('def'))
+    assert stream.getvalue() == ''
+    gevent.sleep(0.05)
+    assert stream.getvalue() == 'abc\ndef\n'
+    handler.close()
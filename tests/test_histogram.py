@@ -0,0 +1,32 @@
+from nylas.util.histogram import Histogram
+
+
+def test_histogram_percentiles():
+    hist = Histogram(bounds=(1, 2, 4, 8))
+    assert hist.percentile(50) is None
+    for value in [0.5] * 50 + [3] * 48 + [7, 20]:
+        hist.add(value)
+    summary = hist.summary()
+    assert summary['count'] == 100
+    assert summary['p50'] == 1
+    assert summary['p99'] == 8
+    assert summary['max'] == 20
+    assert hist.percentile(100) == 20
+
+
+def test_histogram_percentile_capped_at_max():
+    hist = Histogram(bounds=(1, 2, 4, 8))
+    hist.add(2.5)
+    assert hist.percentile(50) == 2.5
+
+
+def test_histogram_merge():
+    a = Histogram(bounds=(1, 2))
+    b = Histogram(bounds=(1, 2))
+    a.add(0.5)
+    b.add(1.5)
+    b.add(5)
+    a.merge(b)
+    assert a.counts == [1, 1, 1]
+    assert a.count == 3
+    assert a.max == 5
@@ -1,8 +1,17 @@
 import sys
 import json
 import logging
+import subprocess
 
-from nylas.logging import configure_logging, get_logger
+import gevent
+from pytest import raises
+
+from nylas.logging import (configure_logging, get_logger, request_context,
+                           bind_request_context, set_request_context,
+                           get_request_context, clear_request_context)
+from nylas.logging import log as log_module
+from nylas.logging.handlers import AsyncStreamHandler
+from nylas.logging.ratelimit import RateLimiter
 
 
 def test_configure_logging():
@@ -17,6 +26,19 @@ def test_configure_logging():
     assert root_logger.getEffectiveLevel() == logging.INFO
 
 
+def test_configure_async_logging():
+    root_logger = logging.getLogger()
+    configure_logging(async_output=True)
+    configure_logging(async_output=True)
+    nylas_handlers = [h for h in root_logger.handlers
+                      if getattr(h, '_nylas', False)]
+    assert len(nylas_handlers) == 1
+    assert isinstance(nylas_handlers[0], AsyncStreamHandler)
+    configure_logging()
+    assert not any(isinstance(h, AsyncStreamHandler)
+                   for h in root_logger.handlers)
+
+
 def test_basic_log(logfile):
     configure_logging()
     log = get_logger()
@@ -33,6 +55,29 @@ def test_basic_log(logfile):
     assert 'exception' not in out
 
 
+def _make_log_helper(module_name):
+    """Returns a function which logs, and appears to live in `module_name`."""
+    namespace = {'__name__': module_name, 'get_logger': get_logger}
+    exec("def helper(msg):\n    get_logger().info(msg)\n", namespace)
+    return namespace['helper']
+
+
+def test_ignore_module_prefixes(logfile):
+    helper = _make_log_helper('someapp.loghelpers')
+
+    configure_logging()
+    helper("0 test")
+    configure_logging(ignore_module_prefixes=['someapp.loghelpers'])
+    helper("1 test")
+    configure_logging()
+    helper("2 test")
+
+    modules = [json.loads(line)['module'] for line in logfile.readlines()]
+    assert modules[0].startswith('someapp.loghelpers:')
+    assert modules[1].startswith(__name__ + ':')
+    assert modules[2].startswith('someapp.loghelpers:')
+
+
 def test_standard_error(logfile):
     configure_logging()
     log = get_logger()
@@ -68,6 +113,30 @@ def test_standard_exception(logfile):
         assert 'exception' not in out
 
 
+def test_repeated_traceback(logfile):
+    def fail():
+        raise ValueError("Test message")
+
+    log = get_logger()
+    for window in (None, 60):
+        configure_logging(traceback_repeat_window=window)
+        for i in range(3):
+            try:
+                fail()
+            except ValueError:
+                log.error("Oh no")
+
+    lines = [json.loads(line) for line in logfile.readlines()]
+    assert len(set(out['error_fingerprint'] for out in lines)) == 1
+    for out in lines[:4]:
+        assert 'error_traceback' in out
+        assert 'error_repeat_count' not in out
+    assert 'error_traceback' not in lines[4]
+    assert lines[4]['error_repeat_count'] == 1
+    assert lines[5]['error_repeat_count'] == 2
+    configure_logging()
+
+
 def test_code(logfile):
     configure_logging()
     log = get_logger()
@@ -237,6 +306,28 @@ def test_lingering_error(logfile):
     assert 'error_traceback' not in out
 
 
+def test_error_logged_from_other_function(logfile):
+    """
+    An exception that is being handled by the caller isn't attached to
+    errors logged from within a different function.
+    """
+    configure_logging()
+    log = get_logger()
+
+    def log_something():
+        log.error("Oh no")
+
+    try:
+        raise ValueError("Test message")
+    except ValueError:
+        log_something()
+
+    out = json.loads(logfile.readlines()[0])
+    assert out['event'] == "Oh no"
+    assert 'error_name' not in out
+    assert 'error_traceback' not in out
+
+
 def test_adjacent_error(logfile):
     """
     NOTE: we can only easily detect the exc_info traceback at the
@@ -264,3 +355,162 @@ def test_adjacent_error(logfile):
     assert out['error_name'] == "ValueError"
     assert out['error_message'] == "Test message"
     assert 'error_traceback' in out
+
+
+def test_disabled_level_short_circuits(logfile, monkeypatch):
+    configure_logging(log_level="info")
+    log = get_logger()
+
+    def fail(*args, **kwargs):
+        raise AssertionError("processors shouldn't run")
+
+    monkeypatch.setattr(log_module, '_processors', [fail])
+    log.debug("Hi")
+
+    monkeypatch.setenv('NYLAS_ENV', 'staging')
+    configure_logging(log_level="debug")
+    log.debug("Hi")
+    out = json.loads(logfile.readlines()[0])
+    assert out['event'] == "Hi"
+    assert out['env'] == "staging"
+
+
+def test_level_changes_outside_configure_logging(logfile):
+    configure_logging(log_level="info")
+    log = get_logger().bind()
+    log.debug("Dropped")
+
+    logging.getLogger().setLevel(logging.DEBUG)
+    log.debug("Root level")
+    logging.getLogger().setLevel(logging.INFO)
+    log._logger.setLevel(logging.DEBUG)
+    log.debug("Own level")
+    log._logger.setLevel(logging.NOTSET)
+    log.debug("Dropped")
+
+    nested = get_logger('nylas_test.levels.nested').bind()
+    nested.debug("Dropped")
+    logging.getLogger('nylas_test.levels').setLevel(logging.DEBUG)
+    nested.debug("Parent level")
+    logging.getLogger('nylas_test.levels').setLevel(logging.NOTSET)
+
+    lines = [json.loads(line) for line in logfile.readlines()]
+    assert [line['event'] for line in lines] == \
+        ["Root level", "Own level", "Parent level"]
+
+
+def test_timestamp_format(logfile):
+    log = get_logger()
+    configure_logging(timestamp_format='epoch_ms')
+    log.info("Hi")
+    configure_logging()
+    log.info("Hi")
+
+    lines = [json.loads(line) for line in logfile.readlines()]
+    assert isinstance(lines[0]['timestamp'], int)
+    assert lines[1]['timestamp'].endswith('Z')
+
+
+def test_rate_limiting(logfile, clock):
+    limiter = RateLimiter(event_limits={'noisy': (0, 2)}, summary_interval=10,
+                          clock=clock)
+    configure_logging(rate_limiter=limiter)
+    log = get_logger()
+
+    for i in range(5):
+        log.info('noisy')
+    clock.now += 10
+    log.info('quiet')
+    configure_logging()
+
+    lines = [json.loads(line) for line in logfile.readlines()]
+    assert [l['event'] for l in lines] == \
+        ['noisy', 'noisy', 'log events suppressed', 'quiet']
+    summary = lines[2]
+    assert summary['suppressed_event'] == 'noisy'
+    assert summary['suppressed_count'] == 3
+    assert summary['suppressed_module'].startswith(__name__ + ':')
+
+
+def test_rate_limiting_skips_module_lookup_for_unlimited_events(
+        logfile, monkeypatch):
+    def fail():
+        raise AssertionError("module shouldn't be looked up")
+
+    configure_logging(rate_limiter=RateLimiter(event_limits={'noisy': (0, 2)}),
+                      profile='prod-fast')
+    monkeypatch.setattr(log_module, '_caller_module', fail)
+    get_logger().info('quiet')
+    configure_logging()
+
+    assert json.loads(logfile.readline())['event'] == 'quiet'
+
+
+def test_request_context(logfile):
+    log = get_logger()
+
+    def handle_request(uid):
+        set_request_context(request_uid=uid)
+        context = get_request_context()
+        gevent.sleep(0)
+        bind_request_context(route='/threads')
+        # Binding doesn't modify contexts that were handed out.
+        assert context == {'request_uid': uid}
+        with request_context(step='auth'):
+            log.info('authenticating')
+        log.info('done', route='/override')
+        clear_request_context()
+        log.info('after')
+
+    gevent.joinall([gevent.spawn(handle_request, uid)
+                    for uid in ('a', 'b')])
+
+    lines = [json.loads(line) for line in logfile.readlines()]
+    assert [(l['event'], l.get('request_uid'), l.get('route'), l.get('step'))
+            for l in lines] == [
+        ('authenticating', 'a', '/threads', 'auth'),
+        ('done', 'a', '/override', None),
+        ('after', None, None, None),
+        ('authenticating', 'b', '/threads', 'auth'),
+        ('done', 'b', '/override', None),
+        ('after', None, None, None)]
+
+
+# Created before any profile is picked, so structlog caches it under the
+# default one.
+cached_log = get_logger()
+
+
+def test_logging_profiles(logfile):
+    cached_log.info('default')
+    configure_logging(profile='prod-fast')
+    cached_log.info('fast', request_uid='abc')
+    configure_logging(profile='debug')
+    assert logging.getLogger().getEffectiveLevel() == logging.DEBUG
+    cached_log.debug('debug')
+    configure_logging()
+    cached_log.debug('dropped')
+    cached_log.info('default again')
+
+    lines = [json.loads(line) for line in logfile.readlines()]
+    assert [l['event'] for l in lines] == \
+        ['default', 'fast', 'debug', 'default again']
+    assert 'module' in lines[0]
+    assert 'module' not in lines[1]
+    assert lines[1]['request_uid'] == 'abc'
+    assert lines[1]['level'] == 'info'
+    assert 'module' in lines[3]
+
+
+def test_unknown_logging_profile():
+    with raises(ValueError):
+        configure_logging(profile='turbo')
+
+
+def test_structlog_is_configured_on_first_use():
+    script = ('import structlog._config, nylas.logging; '
+              'print structlog._config._CONFIG.is_configured; '
+              'nylas.logging.get_logger(); '
+              'print structlog._config._CONFIG.is_configured')
+    output = subprocess.check_output([sys.executable, '-c', script])
+    assert output.split() == ['False', 'True']
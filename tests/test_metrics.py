@@ -0,0 +1,32 @@
+from nylas.api.metrics import RequestMetrics, route_for_path, OTHER
+
+
+def test_route_for_path():
+    assert route_for_path('/messages/5x7kq2/attachments?limit=10') == \
+        '/messages/*/attachments'
+    assert route_for_path('/threads') == '/threads'
+    assert route_for_path(None) is None
+
+
+def test_request_metrics():
+    metrics = RequestMetrics()
+    metrics.record('/threads', 'GET', 200, 0.01, 100)
+    metrics.record('/threads', 'GET', 200, 0.03, 100)
+    metrics.record('/send', 'POST', 500, 2.5, None)
+    snapshot = metrics.pop_snapshot()
+    assert snapshot['requests'] == 3
+    assert snapshot['response_bytes'] == 200
+    assert snapshot['request_time']['max'] == 2.5
+    assert snapshot['by_route']['/threads']['count'] == 2
+    assert snapshot['by_method']['POST']['p99'] == 2.5
+    assert set(snapshot['by_status']) == {200, 500}
+    assert metrics.snapshot()['requests'] == 0
+
+
+def test_request_metrics_bounded():
+    metrics = RequestMetrics(max_keys=2)
+    for i in range(5):
+        metrics.record('/route{}'.format(i), 'GET', 200, 0.01, 0)
+    by_route = metrics.snapshot()['by_route']
+    assert sorted(by_route) == ['/route0', '/route1', OTHER]
+    assert by_route[OTHER]['count'] == 3
@@ -1,5 +1,13 @@
 # -*- coding: utf-8 -*-
-from nylas.logging.log import _safe_encoding_renderer
+import sys
+import json
+import logging
+
+import structlog
+
+from nylas.logging import log as log_module, request_context
+from nylas.logging.log import (_safe_encoding_renderer, _build_processors,
+                               BoundLogger, create_error_log_context)
 
 
 def test_safe_encoding_renderer():
@@ -25,3 +33,41 @@ def test_safe_encoding_renderer():
 
     assert dct['s'] == u'une cha\ufffdne pas comme les autres'
     assert dct['s2'] == u'P\ufffd gensyn!'
+
+
+def test_fused_processor_output_matches_chain(logfile, monkeypatch):
+    monkeypatch.setattr(log_module, '_timestamp',
+                        lambda: '2016-01-02T03:04:05.000006Z')
+    logging.getLogger().setLevel(logging.INFO)
+
+    # Each logger issues the same calls from the same lines, so the output
+    # of the two should be identical.
+    for fused in (False, True):
+        logger = structlog.wrap_logger(
+            logging.getLogger(), processors=_build_processors(fused=fused),
+            wrapper_class=BoundLogger)
+        logger.debug('dropped')
+        with request_context(request_uid='abc', count=0):
+            logger.info('hello', count=1,
+                        latin=u'cha\xeene'.encode('latin-1'))
+        logger.warning('with stack', stack_info=True)
+        logger.error('no exception')
+        logger.error('error string', error='message')
+        try:
+            raise ValueError('Test message')
+        except ValueError as e:
+            logger.error('in scope')
+            logger.exception('exception')
+            logger.error('error object', error=e)
+            logger.info('included', include_exception=True)
+            logger.error('excluded', include_exception=False)
+            logger.warning('exc_info', exc_info=sys.exc_info())
+            logger.info('uncaught',
+                        **create_error_log_context(sys.exc_info()))
+        # Don't let the exception leak into the next iteration.
+        sys.exc_clear()
+
+    lines = logfile.readlines()
+    assert len(lines) == 2 * 11
+    assert lines[:11] == lines[11:]
+    assert 'error_traceback' in json.loads(lines[5])
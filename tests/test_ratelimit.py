@@ -0,0 +1,54 @@
+from nylas.logging.ratelimit import RateLimiter
+
+
+def test_unlimited_by_default():
+    limiter = RateLimiter()
+    assert all(limiter.allow('hi', 'mod:1', 'info') for _ in range(100))
+
+
+def test_token_bucket(clock):
+    limiter = RateLimiter(default_limit=(1, 3), clock=clock)
+    assert [limiter.allow('hi', 'mod:1', 'info') for _ in range(5)] == \
+        [True, True, True, False, False]
+    # Other keys have their own buckets.
+    assert limiter.allow('hi', 'mod:2', 'info')
+    assert limiter.allow('hi', 'mod:1', 'warning')
+
+    clock.now += 1.5
+    assert [limiter.allow('hi', 'mod:1', 'info') for _ in range(3)] == \
+        [True, False, False]
+    assert limiter.total_suppressed == 4
+
+
+def test_most_specific_limit_applies():
+    limiter = RateLimiter(default_limit=(0, 1),
+                          level_limits={'error': (0, 2)},
+                          event_limits={'greenlet blocking': (0, 3)})
+    assert limiter.limit_for('hi', 'info') == (0, 1)
+    assert limiter.limit_for('hi', 'error') == (0, 2)
+    assert limiter.limit_for('greenlet blocking', 'warning') == (0, 3)
+
+
+def test_summaries(clock):
+    limiter = RateLimiter(default_limit=(0, 1), summary_interval=10,
+                          clock=clock)
+    for _ in range(4):
+        limiter.allow('hi', 'mod:1', 'info')
+    assert limiter.pop_summaries() == []
+    clock.now += 5
+    limiter.allow('hi', 'mod:1', 'info')
+    assert limiter.pop_summaries() == []
+    clock.now += 5
+    assert limiter.pop_summaries() == [(('hi', 'mod:1', 'info'), 4)]
+    assert limiter.pop_summaries() == []
+
+
+def test_keys_are_bounded(clock):
+    limiter = RateLimiter(default_limit=(0, 1), max_keys=2, clock=clock)
+    limiter.allow('a', 'mod:1', 'info')
+    limiter.allow('a', 'mod:1', 'info')
+    limiter.allow('b', 'mod:1', 'info')
+    limiter.allow('c', 'mod:1', 'info')
+    assert len(limiter._buckets) == 2
+    # The evicted key's count is summarized straight away.
+    assert limiter.pop_summaries() == [(('a', 'mod:1', 'info'), 1)]
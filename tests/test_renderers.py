@@ -0,0 +1,61 @@
+import json
+import datetime
+
+import pytest
+import structlog
+
+from nylas.logging.renderers import JSONRenderer, SERIALIZERS
+
+
+class StructlogAware(object):
+    def __structlog__(self):
+        return 'custom'
+
+
+def render(serializer, event_dict):
+    return JSONRenderer(serializer=serializer)(None, 'info', event_dict)
+
+
+@pytest.mark.parametrize('serializer', sorted(SERIALIZERS))
+def test_matches_structlog_renderer(serializer):
+    pytest.importorskip(serializer)
+    event_dict = {'event': 'request handled', 'http_status': 200,
+                  'request_time': 0.012345, 'remote_addr': u'10.0.0.1',
+                  'nested': {'a': [1, 2, None, True]}}
+    assert render(serializer, event_dict) == \
+        structlog.processors.JSONRenderer()(None, 'info', event_dict)
+
+
+@pytest.mark.parametrize('serializer', sorted(SERIALIZERS))
+def test_encodes_extra_types(serializer):
+    pytest.importorskip(serializer)
+
+    class CustomError(ValueError):
+        pass
+
+    out = json.loads(render(serializer, {
+        'dt': datetime.datetime(2016, 1, 2, 3, 4, 5, 6),
+        'date': datetime.date(2016, 1, 2),
+        'set': set([1]),
+        'frozenset': frozenset(['a']),
+        'bytearray': bytearray('caf\xe9'),
+        'error': CustomError('bad value'),
+        'empty_error': KeyError(),
+        'custom': StructlogAware(),
+        'other': object,
+    }))
+    assert out['dt'] == '2016-01-02T03:04:05.000006'
+    assert out['date'] == '2016-01-02'
+    assert out['set'] == [1]
+    assert out['frozenset'] == ['a']
+    assert out['bytearray'] == u'caf\ufffd'
+    assert out['error'] == 'CustomError: bad value'
+    assert out['empty_error'] == 'KeyError'
+    assert out['custom'] == 'custom'
+    assert out['other'] == repr(object)
+
+
+def test_custom_serializer():
+    assert render(lambda event_dict: 'rendered', {}) == 'rendered'
+    with pytest.raises(ValueError):
+        JSONRenderer(serializer='nope')
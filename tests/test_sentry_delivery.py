@@ -0,0 +1,69 @@
+import atexit
+
+import gevent
+
+from nylas.logging import sentry
+from nylas.logging.sentry.delivery import (AsyncSentryDelivery, QUEUE_FULL,
+                                           CIRCUIT_OPEN)
+
+
+def test_events_are_sent_in_background_and_coalesced(exc_info_from,
+                                                     sentry_client):
+    delivery = AsyncSentryDelivery(lambda: sentry_client)
+    for _ in range(3):
+        delivery.submit(exc_info_from(1), tags={'a': 1})
+    delivery.submit(exc_info_from(2))
+    delivery.submit_message('hi', extra={'b': 2})
+    assert sentry_client.captured == []
+
+    gevent.sleep(0)
+    assert sentry_client.captured == [
+        (ValueError, {'tags': {'a': 1}, 'extra': {'coalesced_count': 3}}),
+        (ValueError, {}),
+        ('hi', {'extra': {'b': 2}})]
+    assert delivery.stats()['sent'] == 3
+    assert delivery.stats()['coalesced'] == 2
+
+
+def test_full_queue_drops_events(exc_info_from, sentry_client):
+    delivery = AsyncSentryDelivery(lambda: sentry_client, max_queue_size=1)
+    assert delivery.submit(exc_info_from(1))
+    assert not delivery.submit(exc_info_from(2))
+    delivery.flush()
+    assert len(sentry_client.captured) == 1
+    assert delivery.dropped == {QUEUE_FULL: 1}
+
+
+def test_circuit_breaker(clock, exc_info_from, sentry_client):
+    sentry_client.state.failed = True
+    delivery = AsyncSentryDelivery(lambda: sentry_client,
+                                   failure_threshold=2, failure_cooldown=60,
+                                   clock=clock)
+    for line in (1, 2):
+        delivery.submit(exc_info_from(line))
+        delivery.flush()
+    assert delivery.circuit_open
+    assert not delivery.submit(exc_info_from(1))
+    assert delivery.dropped == {CIRCUIT_OPEN: 1}
+    assert len(sentry_client.captured) == 2
+
+    # A successful trial after the cooldown closes the circuit.
+    clock.now += 60
+    sentry_client.state.failed = False
+    delivery.submit(exc_info_from(1))
+    delivery.flush()
+    assert not delivery.circuit_open
+    assert delivery.stats()['sent'] == 1
+
+
+def test_queued_events_are_flushed_at_exit(monkeypatch, exc_info_from,
+                                           sentry_client):
+    registered = []
+    monkeypatch.setattr(sentry, '_async_delivery', None)
+    monkeypatch.setattr(atexit, 'register', registered.append)
+    sentry.enable_async_delivery()
+    sentry.sentry_alert(exc_info_from(1))
+    assert registered == [sentry.flush_sentry_delivery]
+
+    registered[0]()
+    assert sentry_client.captured == [(ValueError, {})]
@@ -0,0 +1,81 @@
+import gevent
+
+from nylas.logging.fingerprint import fingerprint_digest, traceback_fingerprint
+from nylas.logging import sentry
+from nylas.logging.sentry.delivery import AsyncSentryDelivery
+from nylas.logging.sentry.sampling import FingerprintSampler
+
+
+def summarized(captured):
+    """Exception types and messages captured, with the suppressed count of
+    summaries."""
+    return [(event, kwargs['extra']['suppressed_count'])
+            if event == sentry.SUPPRESSED_EXCEPTIONS_SUMMARY else event
+            for event, kwargs in captured]
+
+
+def test_sampler_lets_first_n_through_per_window(clock, exc_info_from):
+    sampler = FingerprintSampler(max_per_window=2, window=60, clock=clock)
+    first = exc_info_from(1)
+    other = exc_info_from(2)
+    assert [sampler.allow(first[0], first[2]) for _ in range(5)] == \
+        [True, True, False, False, False]
+    # Same type, but raised from another line.
+    assert sampler.allow(other[0], other[2])
+    assert sampler.total_suppressed == 3
+    assert sampler.pop_summaries() == []
+
+    clock.now += 60
+    digest = fingerprint_digest(traceback_fingerprint(first[0], first[2]))
+    assert sampler.pop_summaries() == [(ValueError, digest, 3)]
+    assert sampler.allow(first[0], first[2])
+
+
+def test_sampler_summarizes_evicted_fingerprints(exc_info_from):
+    sampler = FingerprintSampler(max_per_window=0, max_fingerprints=1)
+    first = exc_info_from(1)
+    other = exc_info_from(2)
+    assert not sampler.allow(first[0], first[2])
+    assert not sampler.allow(other[0], other[2])
+    summaries = sampler.pop_summaries()
+    assert [count for _, _, count in summaries] == [1]
+
+
+def test_sentry_alert_sampling(monkeypatch, clock, exc_info_from,
+                               sentry_client):
+    monkeypatch.setattr(sentry, '_sampler', FingerprintSampler(
+        max_per_window=1, window=60, clock=clock))
+    for _ in range(3):
+        sentry.sentry_alert(exc_info_from(1))
+    clock.now += 60
+    sentry.sentry_alert(exc_info_from(1))
+    assert summarized(sentry_client.captured) == \
+        [ValueError, (sentry.SUPPRESSED_EXCEPTIONS_SUMMARY, 2), ValueError]
+
+
+def test_summaries_use_async_delivery(monkeypatch, clock, exc_info_from,
+                                      sentry_client):
+    monkeypatch.setattr(sentry, '_async_delivery', AsyncSentryDelivery(
+        lambda: sentry_client))
+    monkeypatch.setattr(sentry, '_sampler', FingerprintSampler(
+        max_per_window=0, window=60, clock=clock))
+    sentry.sentry_alert(exc_info_from(1))
+    clock.now += 60
+    sentry.sentry_alert(exc_info_from(2))
+    assert sentry_client.captured == []
+
+    sentry.flush_sentry_delivery()
+    assert summarized(sentry_client.captured) == \
+        [(sentry.SUPPRESSED_EXCEPTIONS_SUMMARY, 1)]
+
+
+def test_summaries_are_sent_without_further_exceptions(
+        monkeypatch, exc_info_from, sentry_client):
+    monkeypatch.setattr(sentry, '_sampler', None)
+    sentry.enable_sampling(max_per_window=0, window=0.01)
+    sentry.sentry_alert(exc_info_from(1))
+    assert sentry_client.captured == []
+
+    gevent.sleep(0.05)
+    assert summarized(sentry_client.captured) == \
+        [(sentry.SUPPRESSED_EXCEPTIONS_SUMMARY, 1)]
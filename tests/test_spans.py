@@ -0,0 +1,36 @@
+import gevent
+
+from nylas.api.spans import (span, start_request_spans, pop_request_spans,
+                             summarize_spans)
+
+
+def test_spans_outside_request_are_ignored():
+    with span('db'):
+        pass
+    assert pop_request_spans() is None
+
+
+def test_spans_are_per_greenlet():
+    def handle_request(name):
+        start_request_spans()
+        with span(name):
+            gevent.sleep(0.01)
+        with span('render'):
+            pass
+        return pop_request_spans()
+
+    greenlets = [gevent.spawn(handle_request, name)
+                 for name in ('db', 'redis')]
+    first, second = [glet.get() for glet in greenlets]
+    assert [name for name, _, _ in first] == ['db', 'render']
+    assert [name for name, _, _ in second] == ['redis', 'render']
+    _, start, end = first[0]
+    assert end - start >= 0.01
+
+
+def test_summarize_spans():
+    spans = [('db', 10.5, 10.75), ('render', 10.75, 11), ('db', 11, 11.5)]
+    totals, timeline = summarize_spans(spans, 10)
+    assert totals == {'db': 0.75, 'render': 0.25}
+    assert timeline == [['db', 0.5, 0.25], ['render', 0.75, 0.25],
+                        ['db', 1, 0.5]]
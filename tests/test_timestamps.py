@@ -0,0 +1,49 @@
+import random
+import datetime
+
+from pytest import raises
+
+from nylas.logging.timestamps import make_timestamper
+
+DAY = 24 * 60 * 60
+
+
+def expected_iso(now):
+    return datetime.datetime.utcfromtimestamp(now).isoformat() + 'Z'
+
+
+def test_iso_matches_datetime_across_rollovers(clock):
+    timestamp = make_timestamper('iso', clock)
+    midnight = 1474416000  # 2016-09-21T00:00:00Z
+    times = [midnight - DAY - 1, midnight - 1.5, midnight - 1,
+             midnight - 0.000001, midnight - 0.0000004, midnight,
+             midnight + 0.000001, midnight + 0.5, midnight + 1,
+             midnight + 1.999999, midnight + 2]
+    times += [midnight + random.uniform(-DAY, DAY) for _ in range(1000)]
+    times.sort()
+    for now in times:
+        clock.now = now
+        assert timestamp() == expected_iso(now)
+
+    # And going backwards, e.g. after an NTP adjustment.
+    for now in reversed(times):
+        clock.now = now
+        assert timestamp() == expected_iso(now)
+
+
+def test_day_rollover(clock):
+    timestamp = make_timestamper('iso', clock)
+    clock.now = 1474415999.999
+    assert timestamp() == '2016-09-20T23:59:59.999000Z'
+    clock.now = 1474416000.001
+    assert timestamp() == '2016-09-21T00:00:00.001000Z'
+    clock.now = 1474416000
+    assert timestamp() == '2016-09-21T00:00:00Z'
+
+
+def test_epoch_formats(clock):
+    clock.now = 1474416000.1234
+    assert make_timestamper('epoch', clock)() == 1474416000.1234
+    assert make_timestamper('epoch_ms', clock)() == 1474416000123
+    with raises(ValueError):
+        make_timestamper('rfc2822')
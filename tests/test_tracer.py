@@ -0,0 +1,215 @@
+import time
+import collections
+
+import gevent
+import greenlet
+
+from nylas.util.debug import LoopLagMonitor, Tracer, set_greenlet_context
+
+
+def sample_from_here(tracer):
+    tracer._sample()
+
+
+def sample_from_there(tracer):
+    tracer._sample()
+
+
+def test_sampling_profile():
+    tracer = Tracer(sample_interval=0.01)
+    for _ in range(3):
+        sample_from_here(tracer)
+    sample_from_there(tracer)
+
+    lines = tracer.dump_profile().splitlines()
+    assert len(lines) == 2
+    counts = {}
+    for line in lines:
+        stack, count = line.rsplit(' ', 1)
+        frames = stack.split(';')
+        # Outermost frame first. Since we sample the current thread, the
+        # innermost one is _sample itself.
+        assert ':_sample:' in frames[-1]
+        assert ':test_sampling_profile:' in frames[-3]
+        counts[frames[-2].split(':')[1]] = int(count)
+    assert counts == {'sample_from_here': 3, 'sample_from_there': 1}
+    assert tracer.profile_samples == 4
+
+    tracer.reset_profile()
+    assert tracer.dump_profile() == ''
+
+
+def test_profile_is_bounded():
+    tracer = Tracer(sample_interval=0.01, max_profile_stacks=1)
+    sample_from_here(tracer)
+    sample_from_there(tracer)
+    sample_from_here(tracer)
+    assert len(tracer.dump_profile().splitlines()) == 1
+    assert tracer.profile_samples == 3
+    assert tracer.profile_dropped_samples == 1
+
+
+def test_run_slice_histograms(clock):
+    tracer = Tracer(gather_stats=True)
+    tracer._clock = clock
+    worker = gevent.Greenlet()
+    set_greenlet_context('sync', worker)
+    hub = tracer._hub
+
+    tracer._trace('switch', (hub, worker))
+    for duration in (0.001, 0.002, 0.5):
+        clock.now += duration
+        tracer._trace('switch', (worker, hub))
+        clock.now += 0.0001
+        tracer._trace('switch', (hub, worker))
+
+    summary = tracer.run_slices_by_context['sync'].summary()
+    assert summary['count'] == 3
+    assert summary['max'] == 0.5
+    assert 0.001 <= summary['p50'] <= 0.004
+    assert tracer.run_slices_by_context['hub'].count == 3
+    assert round(tracer.time_spent_by_context['sync'], 3) == 0.503
+
+
+def test_set_greenlet_context_defaults_to_current():
+    set_greenlet_context('test')
+    assert greenlet.getcurrent().context == 'test'
+    del greenlet.getcurrent().context
+
+
+def test_light_trace_is_processed_by_monitor(clock):
+    tracer = Tracer(gather_stats=True, light=True)
+    tracer._clock = clock
+    trace = tracer._make_light_trace()
+    worker = gevent.Greenlet()
+    set_greenlet_context('sync', worker)
+    hub = tracer._hub
+
+    trace('switch', (hub, worker))
+    clock.now += 0.25
+    trace('switch', (worker, hub))
+    clock.now += 0.01
+    trace('switch', (hub, worker))
+    assert tracer.total_switches == 0
+
+    tracer._process_switches()
+    assert tracer.total_switches == 3
+    assert tracer._active_greenlet is worker
+    assert tracer._switch_flag
+    assert tracer.run_slices_by_context['sync'].max == 0.25
+    assert tracer.run_slices_by_context['hub'].count == 1
+
+    # The slice that was still running is accounted once the next switch
+    # comes in.
+    clock.now += 0.5
+    trace('switch', (worker, hub))
+    tracer._process_switches()
+    assert tracer.run_slices_by_context['sync'].count == 2
+    assert tracer.time_spent_by_context['sync'] == 0.75
+
+
+def test_light_trace_skips_dropped_switches(clock):
+    tracer = Tracer(gather_stats=True, light=True)
+    tracer._clock = clock
+    tracer._switches = collections.deque(maxlen=2)
+    trace = tracer._make_light_trace()
+    worker = gevent.Greenlet()
+    set_greenlet_context('sync', worker)
+    hub = tracer._hub
+
+    trace('switch', (hub, worker))
+    tracer._process_switches()
+    # The worker ran for a second, but the switches in between are dropped.
+    for _ in range(3):
+        clock.now += 0.5
+        trace('switch', (worker, hub))
+        trace('switch', (hub, worker))
+    tracer._process_switches()
+
+    assert tracer.total_switches == 7
+    assert tracer.dropped_switches == 4
+    assert 'sync' not in tracer.time_spent_by_context
+    assert tracer._active_greenlet is worker
+
+    clock.now += 0.25
+    trace('switch', (worker, hub))
+    tracer._process_switches()
+    assert tracer.time_spent_by_context['sync'] == 0.25
+    assert tracer.dropped_switches == 4
+
+
+def test_loop_lag_monitor_measures_blocking():
+    monitor = LoopLagMonitor(interval=0.01, log_interval=None)
+    monitor.start()
+    try:
+        gevent.sleep(0.02)
+        # Block the loop well past the next scheduled tick.
+        deadline = time.time() + 0.1
+        while time.time() < deadline:
+            pass
+        gevent.sleep(0.02)
+    finally:
+        monitor.stop()
+    stats = monitor.stats()
+    assert stats['lag']['count'] >= 2
+    assert stats['lag']['max'] >= 0.08
+
+
+def test_loop_lag_monitor_windows():
+    monitor = LoopLagMonitor(log_interval=60)
+    monitor.record(0.5, 3, 1)
+    monitor._rotate(now=60)
+    monitor.record(0.01, 10, 0)
+    stats = monitor.stats()
+    assert stats['lag']['count'] == 2
+    assert stats['lag']['max'] == 0.5
+    assert stats['max_runnable_greenlets'] == 10
+    assert stats['max_pending_callbacks'] == 1
+    assert stats['last_lag'] == 0.01
+    assert stats['recent_lag'] == 0.5
+
+    monitor._rotate(now=120)
+    assert monitor.stats()['lag']['max'] == 0.01
+
+
+class RecordingLog(object):
+    def __init__(self):
+        self.events = []
+
+    def warning(self, event, **kwargs):
+        self.events.append((event, kwargs))
+
+
+def block_repeatedly(tracer, glet, times):
+    for _ in range(times):
+        tracer._active_greenlet = glet
+        tracer._switch_flag = False
+        tracer._check_blocking()
+
+
+def test_repeated_blocking_is_aggregated():
+    tracer = Tracer(max_blocking_time=1)
+    tracer.log = log = RecordingLog()
+    block_repeatedly(tracer, gevent.Greenlet(), 3)
+
+    events = [event for event, _ in log.events]
+    assert events == ['greenlet blocking', 'greenlet still blocking',
+                      'greenlet still blocking']
+    first, last = log.events[0][1], log.events[-1][1]
+    assert 'block_repeatedly' in first['frame']
+    assert 'frame' not in last
+    assert last['repeat_count'] == 2
+    assert last['fingerprint'] == first['fingerprint']
+    assert last['blocking_time'] >= first['blocking_time'] >= 1
+
+    # A switch ends the block.
+    tracer._switch_flag = True
+    tracer._check_blocking()
+    assert tracer._blocking_since is None
+
+
+def test_blocking_repeat_window():
+    tracer = Tracer(blocking_repeat_window=0)
+    tracer.log = log = RecordingLog()
+    block_repeatedly(tracer, gevent.Greenlet(), 2)
+    assert [event for event, _ in log.events] == ['greenlet blocking'] * 2
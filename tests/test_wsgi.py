@@ -0,0 +1,258 @@
+import json
+
+import gevent
+import gevent.socket
+from gevent.event import Event
+from gevent.pywsgi import WSGIServer
+from pytest import fixture
+
+from nylas.api import wsgi
+from nylas.api.admission import AdmissionControl
+from nylas.api.metrics import RequestMetrics
+from nylas.api.spans import span
+from nylas.logging import get_logger, get_request_context
+from nylas.logging.context import _ATTRIBUTE as CONTEXT_ATTRIBUTE
+
+
+class RecordingLog(object):
+    def __init__(self):
+        self.events = []
+
+    def info(self, event, **kwargs):
+        self.events.append((event, kwargs))
+
+    def wait_for_request(self, timeout=5):
+        with gevent.Timeout(timeout):
+            while not self.events:
+                gevent.sleep(0.01)
+        event, kwargs = self.events.pop(0)
+        assert event == 'request handled'
+        return kwargs
+
+
+def app(environ, start_response):
+    path = environ['PATH_INFO']
+    start_response('200 OK', [('Content-Type', 'text/plain')])
+    if path == '/stream':
+        environ['nylas.streaming'] = True
+        return iter(['x' * 100000, 'y' * 10, 'z' * 20000])
+    if path == '/forever':
+        environ['nylas.streaming'] = True
+        return ('x' * 65536 for _ in iter(int, 1))
+    return iter(['x' * 100000, 'y' * 10])
+
+
+@fixture
+def server():
+    server = WSGIServer(('127.0.0.1', 0), app,
+                        handler_class=wsgi.NylasWSGIHandler,
+                        log=RecordingLog())
+    server.start()
+    yield server
+    server.stop(timeout=1)
+
+
+def get(server, path, headers=''):
+    sock = gevent.socket.create_connection(('127.0.0.1', server.server_port))
+    sock.sendall('GET {} HTTP/1.1\r\nHost: test\r\n{}'
+                 'Connection: close\r\n\r\n'.format(path, headers))
+    response = []
+    with gevent.Timeout(5):
+        while True:
+            data = sock.recv(65536)
+            if not data:
+                break
+            response.append(data)
+    sock.close()
+    headers, body = ''.join(response).split('\r\n\r\n', 1)
+    return headers, body
+
+
+def test_streaming_response(server):
+    headers, body = get(server, '/stream')
+    assert 'Transfer-Encoding: chunked' in headers
+    # Chunks above MIN_ZERO_COPY_CHUNK are sent separately from their
+    # framing, which must come out the same.
+    assert body == '186a0\r\n' + 'x' * 100000 + '\r\n' + \
+        'a\r\n' + 'y' * 10 + '\r\n' + \
+        '4e20\r\n' + 'z' * 20000 + '\r\n' + \
+        '0\r\n\r\n'
+
+    logged = server.log.wait_for_request()
+    assert logged['streaming'] is True
+    assert logged['stream_chunks'] == 3
+    assert logged['stream_bytes'] == 120010
+    assert logged['response_bytes'] == len(headers) + 4 + len(body)
+    assert 'stream_timed_out' not in logged
+
+
+def test_stalled_streaming_client_is_closed(server, monkeypatch):
+    monkeypatch.setattr(wsgi, 'STREAM_WRITE_TIMEOUT', 0.1)
+    sock = gevent.socket.create_connection(('127.0.0.1', server.server_port))
+    sock.sendall('GET /forever HTTP/1.1\r\nHost: test\r\n\r\n')
+    # Never read, so that the server's writes eventually block.
+    logged = server.log.wait_for_request()
+    assert logged['stream_timed_out'] is True
+    assert logged['stream_chunks'] > 0
+
+    # The server closed the connection after the data already sent.
+    with gevent.Timeout(5):
+        while sock.recv(65536):
+            pass
+    sock.close()
+
+
+def test_non_streaming_response_is_unchanged(server, monkeypatch):
+    def fail(data):
+        raise AssertionError("response shouldn't take the zero-copy path")
+
+    monkeypatch.setattr(wsgi, 'memoryview', fail, raising=False)
+    headers, body = get(server, '/')
+    assert body == '186a0\r\n' + 'x' * 100000 + '\r\n' + \
+        'a\r\n' + 'y' * 10 + '\r\n' + '0\r\n\r\n'
+
+    logged = server.log.wait_for_request()
+    assert 'streaming' not in logged
+    assert 'stream_chunks' not in logged
+
+
+def test_request_metrics(server, monkeypatch):
+    metrics = RequestMetrics()
+    monkeypatch.setattr(wsgi, 'request_metrics', metrics)
+    get(server, '/')
+    server.log.wait_for_request()
+    assert metrics.requests == 0
+
+    monkeypatch.setattr(wsgi, 'METRICS_INTERVAL', 60)
+    for path in ('/messages/1234', '/messages/5678'):
+        get(server, path)
+        server.log.wait_for_request()
+    snapshot = metrics.snapshot()
+    assert snapshot['requests'] == 2
+    assert snapshot['by_route'].keys() == ['/messages/*']
+    assert snapshot['by_method'].keys() == ['GET']
+    assert snapshot['by_status'].keys() == [200]
+
+
+def test_request_context(server, logfile):
+    seen = []
+
+    def context_app(environ, start_response):
+        glet = gevent.getcurrent()
+        seen.append((glet, get_request_context()))
+        get_logger().info('in app')
+        if environ['PATH_INFO'] == '/raise':
+            raise ValueError()
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        return ['hi']
+    server.application = context_app
+
+    get(server, '/ok?x=1', 'X-Unique-Id: abc\r\n')
+    server.log.wait_for_request()
+    headers, _ = get(server, '/raise')
+    assert headers.startswith('HTTP/1.1 500')
+    server.log.wait_for_request()
+
+    assert [context for _, context in seen] == [
+        {'request_method': 'GET', 'request_path': '/ok',
+         'request_uid': 'abc'},
+        {'request_method': 'GET', 'request_path': '/raise'}]
+    # Cleared once the request is over, whether or not the app raised.
+    for glet, _ in seen:
+        assert not hasattr(glet, CONTEXT_ATTRIBUTE)
+
+    lines = [json.loads(line) for line in logfile.readlines()]
+    in_app = [line for line in lines if line['event'] == 'in app']
+    assert in_app[0]['request_path'] == '/ok'
+    assert in_app[0]['request_uid'] == 'abc'
+    assert in_app[1]['request_path'] == '/raise'
+
+
+def slow_app(environ, start_response):
+    with span('db'):
+        gevent.sleep(float(environ['QUERY_STRING']))
+    with span('render'):
+        pass
+    start_response('200 OK', [('Content-Type', 'text/plain')])
+    return ['hi']
+
+
+def test_slow_request_spans(server, monkeypatch):
+    monkeypatch.setattr(wsgi, 'SLOW_REQUEST_TIME', 0.05)
+    server.application = slow_app
+
+    get(server, '/?0')
+    logged = server.log.wait_for_request()
+    assert 'span_totals' not in logged
+    assert 'slow_request_stack' not in logged
+
+    get(server, '/?0.1')
+    logged = server.log.wait_for_request()
+    assert set(logged['span_totals']) == {'db', 'render'}
+    assert logged['span_totals']['db'] >= 0.1
+    assert [name for name, _, _ in logged['spans']] == ['db', 'render']
+    assert 'slow_request_stack' not in logged
+
+
+def test_slow_request_stack(server, monkeypatch):
+    captures = []
+    capture = wsgi.NylasWSGIHandler._capture_slow_stack.__func__
+
+    def record_capture(handler, glet):
+        captures.append(glet)
+        capture(handler, glet)
+    monkeypatch.setattr(wsgi, 'SLOW_REQUEST_TIME', 0.05)
+    monkeypatch.setattr(wsgi, 'SLOW_REQUEST_STACK', True)
+    monkeypatch.setattr(wsgi.NylasWSGIHandler, '_capture_slow_stack',
+                        record_capture)
+    server.application = slow_app
+
+    get(server, '/?0.1')
+    logged = server.log.wait_for_request()
+    assert len(captures) == 1
+    assert 'in slow_app' in logged['slow_request_stack']
+
+    # The timer of a fast request is cancelled when it's done.
+    get(server, '/?0')
+    logged = server.log.wait_for_request()
+    gevent.sleep(0.1)
+    assert len(captures) == 1
+    assert 'slow_request_stack' not in logged
+
+
+def test_requests_are_shed_above_in_flight_limit(server, monkeypatch):
+    monkeypatch.setattr(wsgi, 'MAX_IN_FLIGHT_REQUESTS', 1)
+    monkeypatch.setattr(wsgi, 'RETRY_AFTER', 3)
+    monkeypatch.setattr(wsgi, 'admission_control', AdmissionControl())
+    called = []
+    release = Event()
+
+    def blocking_app(environ, start_response):
+        called.append(environ['PATH_INFO'])
+        if environ['PATH_INFO'] == '/block':
+            release.wait()
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        return ['hi']
+    server.application = blocking_app
+
+    blocked = gevent.spawn(get, server, '/block')
+    with gevent.Timeout(5):
+        while not called:
+            gevent.sleep(0.01)
+    headers, _ = get(server, '/shed')
+    assert headers.startswith('HTTP/1.1 503')
+    assert 'Retry-After: 3' in headers
+    assert called == ['/block']
+
+    logged = server.log.wait_for_request()
+    assert logged['http_status'] == 503
+    assert logged['shed_reason'] == 'in_flight'
+    assert logged['in_flight_requests'] == 1
+    assert logged['shed_requests'] == 1
+
+    release.set()
+    headers, body = blocked.get(timeout=5)
+    assert headers.startswith('HTTP/1.1 200')
+    logged = server.log.wait_for_request()
+    assert 'shed_reason' not in logged
+    assert logged['shed_requests'] == 1